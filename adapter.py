@@ -0,0 +1,228 @@
+import time
+
+import dbus
+
+def discovery_filter(uuids = None, rssi = None, duplicate_data = True):
+    """
+    Builds the argument of Adapter1.SetDiscoveryFilter. Only LE devices are
+    looked for, and when given, only those advertising one of `uuids` (as a
+    service UUID or as service data) and heard louder than `rssi` dBm.
+
+    With duplicate_data False, bluetoothd stops emitting PropertiesChanged
+    for advertisements that did not change.
+    """
+    discovery_filter = {
+        'Transport': dbus.String('le'),
+        'DuplicateData': dbus.Boolean(duplicate_data),
+    }
+
+    if uuids:
+        discovery_filter['UUIDs'] = dbus.Array(uuids, signature = 's')
+
+    if rssi is not None:
+        discovery_filter['RSSI'] = dbus.Int16(rssi)
+
+    return dbus.Dictionary(discovery_filter, signature = 'sv')
+
+class AdapterWatchdog:
+    """
+    Keeps a BlueZ adapter powered and discovering.
+
+    Rather than polling the adapter and power cycling it blindly, it listens
+    to the adapter's own PropertiesChanged signal to restart discovery as soon
+    as it stops, and every `interval` seconds compares the rate of
+    advertisements received from the beacons to the rate it learnt so far.
+    The adapter is only reset when discovery cannot be restarted or when that
+    rate falls below `stall_ratio` times the usual one. When powering on or
+    starting discovery fails, no signal comes to try again on, so the checks
+    retry it, waiting twice as long after each failure up to `max_backoff`
+    seconds.
+
+    When given, `discovery_filter` is set before each start of discovery, as
+    bluetoothd forgets it when discovery stops.
+    """
+
+    def __init__(self, bus, adapter_path, beacons, interval = 60, stall_ratio = 0.2, learning_checks = 5, discovery_filter = None, max_backoff = 3600):
+        self.bus = bus
+        self.adapter_path = adapter_path
+        self.beacons = beacons
+        self.interval = interval
+        self.stall_ratio = stall_ratio
+        self.learning_checks = learning_checks
+        self.discovery_filter = discovery_filter
+        self.max_backoff = max_backoff
+
+        proxy = bus.get_object("org.bluez", adapter_path)
+        self.adapter = dbus.Interface(proxy, "org.bluez.Adapter1")
+        self.properties = dbus.Interface(proxy, "org.freedesktop.DBus.Properties")
+
+        self.powered = False
+        self.discovering = False
+
+        # Advertisements per second, smoothed over the previous checks
+        self.baseline = None
+        self.checks = 0
+        self.last_check = None
+        self.last_signals = {}
+        self.rates = {}
+
+        self.resets = 0
+        self.reset_reason = None
+        self.reset_started = None
+
+        # Attempts at getting the adapter powered and discovering again
+        # since it last was
+        self.retries = 0
+        self.next_retry = None
+
+    def start(self):
+        self.bus.add_signal_receiver(self.adapter_changed, bus_name = "org.bluez", dbus_interface = "org.freedesktop.DBus.Properties", signal_name = "PropertiesChanged", path = self.adapter_path)
+
+        self.refresh()
+
+        if not self.powered:
+            self.power_on()
+        elif not self.discovering or self.discovery_filter is not None:
+            # Discovery started by somebody else would not be filtered
+            self.start_discovery()
+
+        self.last_check = time.monotonic()
+        self.last_signals = {beacon.name: self.signals(beacon) for beacon in self.beacons}
+
+    def refresh(self):
+        self.powered = bool(self.properties.Get('org.bluez.Adapter1', 'Powered'))
+        self.discovering = bool(self.properties.Get('org.bluez.Adapter1', 'Discovering'))
+
+    def signals(self, beacon):
+        return beacon.adapter_signals.get(self.adapter_path, 0)
+
+    def adapter_changed(self, interface, changed, invalidated):
+        if interface != 'org.bluez.Adapter1':
+            return
+
+        if 'Powered' in changed:
+            self.powered = bool(changed['Powered'])
+            if not self.powered:
+                print("Adapter", self.adapter_path, "powered off")
+                self.power_on()
+            else:
+                self.retries = 0
+                self.next_retry = None
+                if not self.discovering and 'Discovering' not in changed:
+                    # Back on after a reset, or powered on at startup,
+                    # discovery has to be started again
+                    self.start_discovery()
+
+        if 'Discovering' in changed:
+            self.discovering = bool(changed['Discovering'])
+            if self.discovering:
+                if self.reset_started is not None:
+                    print("Adapter", self.adapter_path, "recovered in %.1f s after reset (%s)" % (time.monotonic() - self.reset_started, self.reset_reason))
+                    self.reset_started = None
+            elif self.powered:
+                print("Adapter", self.adapter_path, "stopped discovering")
+                self.start_discovery()
+
+    def power_on(self):
+        print("Starting power")
+        try:
+            self.properties.Set('org.bluez.Adapter1', 'Powered', True)
+        except Exception as e:
+            print("Could not power on ", e)
+
+    def start_discovery(self):
+        print("Starting discovery")
+        if self.discovery_filter is not None:
+            try:
+                self.adapter.SetDiscoveryFilter(self.discovery_filter)
+            except Exception as e:
+                print("Could not set discovery filter ", e)
+
+        try:
+            self.adapter.StartDiscovery()
+        except Exception as e:
+            print("Could not start discovery ", e)
+            self.reset("discovery could not be restarted: " + str(e))
+
+    def reset(self, reason):
+        if self.reset_started is not None:
+            # Still waiting for the previous reset to come through
+            return
+
+        self.resets += 1
+        self.reset_reason = reason
+        self.reset_started = time.monotonic()
+
+        print("Resetting adapter", self.adapter_path, "-", reason)
+        try:
+            # Powering back on is done when the adapter says it is off
+            self.properties.Set('org.bluez.Adapter1', 'Powered', False)
+        except Exception as e:
+            print("Could not power off", e)
+
+    def check(self):
+        now = time.monotonic()
+        elapsed = now - self.last_check
+        if elapsed <= 0:
+            return True
+
+        total = 0
+        for beacon in self.beacons:
+            count = self.signals(beacon)
+            # Counts are carried over on reload, but never let one going
+            # backwards make a negative rate
+            signals = max(0, count - self.last_signals.get(beacon.name, count))
+            self.rates[beacon.name] = signals / elapsed
+            self.last_signals[beacon.name] = count
+            total += signals
+
+        self.last_check = now
+        rate = total / elapsed
+
+        if self.reset_started is not None:
+            if now - self.reset_started > self.interval * 5:
+                print("Adapter", self.adapter_path, "did not recover from reset (%s)" % self.reset_reason)
+                self.reset_started = None
+            return True
+
+        if not self.powered or not self.discovering:
+            self.retry(now)
+            return True
+
+        self.retries = 0
+        self.next_retry = None
+
+        if self.checks >= self.learning_checks and rate < self.baseline * self.stall_ratio:
+            silent = [name for name, beacon_rate in self.rates.items() if beacon_rate == 0]
+            self.reset("%.2f advertisements/s against %.2f usually, silent beacons: %s" % (rate, self.baseline, ', '.join(silent) or 'none'))
+            return True
+
+        if self.baseline is None:
+            self.baseline = rate
+        else:
+            self.baseline = 0.9 * self.baseline + 0.1 * rate
+
+        self.checks += 1
+        return True
+
+    def retry(self, now):
+        if self.next_retry is not None and now < self.next_retry:
+            return
+
+        # What was missed while the adapter was misbehaving
+        try:
+            self.refresh()
+        except Exception as e:
+            print("Could not read adapter state", e)
+
+        if self.powered and self.discovering:
+            return
+
+        self.next_retry = now + min(self.interval * 2 ** self.retries, self.max_backoff)
+        self.retries += 1
+
+        print("Adapter", self.adapter_path, "still not", "discovering" if self.powered else "powered", "- attempt", self.retries)
+        if not self.powered:
+            self.power_on()
+        else:
+            self.start_discovery()
@@ -0,0 +1,173 @@
+import asyncio
+import math
+import struct
+import threading
+import time
+
+import dbus
+
+from upload_queue import reading
+
+# LYWSD02 and the like keep one record per hour of the min and max
+# temperature and humidity, readable over GATT. Writing a record index to
+# RECORD_INDEX and subscribing to HISTORY gets every record from that index
+# on as notifications.
+LYWSD02_RECORD_COUNT = 'ebe0ccb9-7a0a-4b0c-8a1a-6ff2997da3a6'
+LYWSD02_RECORD_INDEX = 'ebe0ccba-7a0a-4b0c-8a1a-6ff2997da3a6'
+LYWSD02_HISTORY = 'ebe0ccbc-7a0a-4b0c-8a1a-6ff2997da3a6'
+
+LYWSD02_RECORD = struct.Struct('<IIhBhB')
+UINT32 = struct.Struct('<I')
+
+class Backfill:
+    """
+    Fetches the history kept by the beacons themselves to fill the gaps in
+    what the listener received, after the gateway was down or out of range.
+
+    check() runs periodically. A beacon with backfill enabled that is heard
+    again after `gap` seconds of silence gets connected to. The hourly records
+    covering the gap are downloaded and sent as one batch of timestamped
+    readings. At most `concurrency` beacons are connected to at a time, the
+    adapter still having to scan for everybody else meanwhile.
+    """
+
+    def __init__(self, bus, beacons, send, failed = None, gap = 3600, concurrency = 1, timeout = 30, coordinator = None, adapter_path = '/org/bluez/hci0'):
+        self.bus = bus
+        self.beacons = beacons
+        self.send = send
+        self.failed = failed
+        self.gap = gap
+        self.timeout = timeout
+        self.coordinator = coordinator
+        self.adapter_path = adapter_path
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        self.last_signals = {}
+        self.running = set()
+
+        self.backfilled = 0
+        self.errors = 0
+
+    def check(self):
+        now = time.time()
+
+        for beacon in self.beacons:
+            if not beacon.backfill:
+                continue
+
+            heard = beacon.signals != self.last_signals.get(beacon.name, 0)
+            self.last_signals[beacon.name] = beacon.signals
+            if not heard:
+                continue
+
+            if beacon.last_heard is not None and now - beacon.last_heard > self.gap and beacon.name not in self.running:
+                if self.coordinator is None or self.coordinator.elected(beacon):
+                    self.running.add(beacon.name)
+                    asyncio.create_task(self.run(beacon, beacon.last_heard, now))
+
+            beacon.last_heard = now
+
+        return True
+
+    async def run(self, beacon, since, until):
+        try:
+            async with self.semaphore:
+                print("Backfilling", beacon.name, "from", time.strftime('%Y-%m-%d %H:%M', time.localtime(since)))
+                records = await asyncio.get_running_loop().run_in_executor(None, self.download, beacon, since)
+        except Exception as e:
+            print("Could not backfill", beacon.name, e)
+            self.errors += 1
+            return
+        finally:
+            self.running.discard(beacon.name)
+
+        readings = []
+        for when, minimum_temperature, maximum_temperature, minimum_humidity, maximum_humidity in records:
+            if not since < when < until:
+                continue
+
+            if 'temperature' in beacon.sensors:
+                readings.append(reading(beacon.sensors['temperature'], (minimum_temperature + maximum_temperature) / 2, stats={'min': minimum_temperature, 'max': maximum_temperature}, when=when))
+            if 'humidity' in beacon.sensors:
+                readings.append(reading(beacon.sensors['humidity'], (minimum_humidity + maximum_humidity) / 2, stats={'min': minimum_humidity, 'max': maximum_humidity}, when=when))
+
+        print("Backfilled", len(readings), "readings for", beacon.name)
+        if not readings:
+            return
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.send, readings)
+            self.backfilled += len(readings)
+        except Exception as e:
+            print("Could not upload backfill for", beacon.name, e)
+            if self.failed is not None:
+                self.failed(readings)
+
+    # Called from an executor thread, the D-Bus calls block
+
+    def characteristics(self, device_path):
+        manager = dbus.Interface(self.bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
+        characteristics = {}
+        for path, interfaces in manager.GetManagedObjects().items():
+            if path.startswith(device_path + '/') and 'org.bluez.GattCharacteristic1' in interfaces:
+                uuid = str(interfaces['org.bluez.GattCharacteristic1']['UUID']).lower()
+                characteristics[uuid] = path
+
+        return characteristics
+
+    def download(self, beacon, since):
+        device_path = beacon.device_path(beacon.elected_adapter or beacon.adapter or self.adapter_path)
+        proxy = self.bus.get_object("org.bluez", device_path)
+        device = dbus.Interface(proxy, "org.bluez.Device1")
+        properties = dbus.Interface(proxy, "org.freedesktop.DBus.Properties")
+
+        device.Connect(timeout=self.timeout)
+        try:
+            deadline = time.monotonic() + self.timeout
+            while not properties.Get('org.bluez.Device1', 'ServicesResolved'):
+                if time.monotonic() > deadline:
+                    raise TimeoutError("services not resolved")
+                time.sleep(0.2)
+
+            return self.download_records(self.characteristics(device_path), since)
+        finally:
+            device.Disconnect()
+
+    def download_records(self, characteristics, since):
+        def characteristic(uuid):
+            return dbus.Interface(self.bus.get_object("org.bluez", characteristics[uuid]), "org.bluez.GattCharacteristic1")
+
+        count, = UINT32.unpack_from(bytes(characteristic(LYWSD02_RECORD_COUNT).ReadValue({})))
+
+        # One record per hour, the last ones are those we need
+        needed = math.ceil((time.time() - since) / 3600) + 1
+        start = max(0, count - needed)
+        characteristic(LYWSD02_RECORD_INDEX).WriteValue(dbus.Array(UINT32.pack(start), signature='y'), {})
+
+        records = []
+        received = threading.Event()
+
+        def history_changed(interface, changed, invalidated):
+            if interface == 'org.bluez.GattCharacteristic1' and 'Value' in changed:
+                index, when, maximum_temperature, maximum_humidity, minimum_temperature, minimum_humidity = LYWSD02_RECORD.unpack_from(bytes(changed['Value']))
+                records.append((when, minimum_temperature / 100, maximum_temperature / 100, minimum_humidity, maximum_humidity))
+                received.set()
+
+        receiver = self.bus.add_signal_receiver(history_changed, bus_name = "org.bluez", dbus_interface = "org.freedesktop.DBus.Properties", signal_name = "PropertiesChanged", path = characteristics[LYWSD02_HISTORY])
+        history = characteristic(LYWSD02_HISTORY)
+        history.StartNotify()
+        try:
+            # Records come in a burst, two seconds without one means done
+            while len(records) < count - start and received.wait(2):
+                received.clear()
+        finally:
+            history.StopNotify()
+            receiver.remove()
+
+        return records
+
+    def metrics(self):
+        return [
+            ('veranda_backfill_readings_total', 'counter', "Readings recovered from the history kept by beacons", [({}, self.backfilled)]),
+            ('veranda_backfill_errors_total', 'counter', "Backfills that failed", [({}, self.errors)]),
+        ]
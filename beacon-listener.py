@@ -1,216 +1,306 @@
 import dbus
 import sys
 import os
+import socket
+import time
+
+import asyncio
+import signal
 
 import configparser
 from itertools import chain
 
-from urllib.request import Request, urlopen
+from adapter import AdapterWatchdog, discovery_filter
+from backfill import Backfill
+from beacons import adapter_path, load_beacons
+from capture import Recorder
+from core import ListenerCore
+from decoders import service_decoders
+from gossip import Gossip, parse_peers
+from hci import HCIScanner
+from history import History
+from listener import Listener
+from metrics import DECODE_BUCKETS, UPLOAD_BUCKETS, Histogram, Metrics
+from mqtt import MQTTPublisher
+from profiling import Profiler
+from spool import Spool
+from state import restore_state, save_state
+from upload_queue import AsyncUploadQueue
+from veranda_api import API_BASE_URL, APIClient
+
+config_path = os.getenv('HOME') + '/.verandarc'
+
+def read_config():
+    config = configparser.ConfigParser()
+
+    with open(config_path, 'r') as lines:
+        lines = chain(("[root]",), lines)
+        config.read_file(lines)
+
+    return config['root']
+
+settings = read_config()
+
+if ('api-key' not in settings) or ('ble' not in settings):
+    sys.exit(0)
+
+api_key = settings['api-key']
+api_base_url = settings.get('url', API_BASE_URL)
+queue_depth = int(settings.get('ble_queue_depth', 1000))
+upload_workers = int(settings.get('ble_upload_workers', 2))
+batch_size = int(settings.get('ble_batch_size', 1))
+batch_interval = float(settings.get('ble_batch_interval', 30))
+spool_path = settings.get('ble_spool')
+spool_max_readings = int(settings.get('ble_spool_max_readings', 100000))
+spool_replay_rate = float(settings.get('ble_spool_replay_rate', 10))
+state_path = settings.get('ble_state')
+state_interval = float(settings.get('ble_state_interval', 60))
+capture_path = settings.get('ble_capture')
+history_path = settings.get('ble_history')
+history_raw_slots = int(settings.get('ble_history_raw_slots', 17280))
+backend = settings.get('ble_backend', 'dbus')
+adapter_paths = [adapter_path(adapter) for adapter in settings.get('ble_adapters', 'hci0').split()]
+adapter_failover = float(settings.get('ble_adapter_failover', 120))
+watchdog_interval = float(settings.get('ble_watchdog_interval', 60))
+watchdog_stall_ratio = float(settings.get('ble_watchdog_stall_ratio', 0.2))
+scan = settings.get('ble_scan')
+rssi_floor = settings.get('ble_rssi_floor')
+duplicate_data = settings.get('ble_duplicate_data', 'yes') == 'yes'
+filter_uuids = settings.get('ble_filter_uuids', 'no') == 'yes'
+profile_directory = os.path.expanduser(settings.get('ble_profile_directory', '/tmp'))
+allocations_interval = settings.get('ble_allocations_interval')
+mqtt_host = settings.get('ble_mqtt_host')
+mqtt_port = int(settings.get('ble_mqtt_port', 1883))
+mqtt_prefix = settings.get('ble_mqtt_prefix', 'veranda')
+mqtt_username = settings.get('ble_mqtt_username')
+mqtt_password = settings.get('ble_mqtt_password')
+gossip_port = settings.get('ble_gossip_port')
+gossip_peers = settings.get('ble_gossip_peers', '')
+gossip_interval = float(settings.get('ble_gossip_interval', 5))
+gossip_failover = float(settings.get('ble_gossip_failover', 120))
+gateway_name = settings.get('ble_gateway_name', socket.gethostname())
+backfill_gap = float(settings.get('ble_backfill_gap', 3600))
+backfill_concurrency = int(settings.get('ble_backfill_concurrency', 1))
+metrics_port = settings.get('ble_metrics_port')
+metrics_address = settings.get('ble_metrics_address', '127.0.0.1')
+beacons = load_beacons(settings)
 
-config = configparser.ConfigParser()
+from dbus.mainloop.glib import DBusGMainLoop
+DBusGMainLoop(set_as_default=True)
 
-beacons = []
+bus = dbus.SystemBus()
 
-with open(os.getenv('HOME') + '/.verandarc', 'r') as lines:
-    lines = chain(("[root]",), lines)
-    config.read_file(lines)
+api = APIClient(api_key, api_base_url, pool_size=upload_workers)
 
-    if ('api-key' not in config['root']) or ('ble' not in config['root']):
-        sys.exit(0)
+def send_readings(readings):
+    print(api.upload(readings))
 
-    api_key = config['root']['api-key']
-    beacon_names = config['root']['ble'].split(" ")
+spool = None
+backfill_spool = None
+if spool_path is not None:
+    spool = Spool(os.path.expanduser(spool_path), max_readings=spool_max_readings)
+    # Replayed as batches only, see send_backfill()
+    backfill_spool = Spool(os.path.expanduser(spool_path), max_readings=spool_max_readings, table='backfill')
 
-    for beacon_name in beacon_names:
-        if ('ble_' + beacon_name + '_address') in config['root']:
-            beacon = {'name': beacon_name, 'address': config['root']['ble_' + beacon_name + '_address'], 'last-battery': 0}
+def spool_readings(readings):
+    if spool is not None:
+        spool.add(readings)
 
-            if 'ble_' + beacon_name + '_id' in config['root']:
-                beacon['id'] = config['root']['ble_' + beacon_name + '_id']
+def spool_backfill(readings):
+    if backfill_spool is not None:
+        backfill_spool.add(readings)
+    else:
+        print("No ble_spool configured, dropping", len(readings), "backfilled readings")
 
-            if 'ble_' + beacon_name + '_humidity_id' in config['root']:
-                beacon['humidity_id'] = config['root']['ble_' + beacon_name + '_humidity_id']
+uploads = AsyncUploadQueue(send_readings, depth=queue_depth, workers=upload_workers, batch_size=batch_size, batch_interval=batch_interval, failed=spool_readings)
 
-            if 'ble_' + beacon_name + '_signal_id' in config['root']:
-                beacon['signal_id'] = config['root']['ble_' + beacon_name + '_signal_id']
+listener = Listener(beacons, uploads, adapter_paths, failover=adapter_failover)
+for beacon in listener.beacons:
+    print('Listening to beacon', beacon)
 
-            beacons.append(beacon)
+core = ListenerCore(listener, uploads, spool)
 
-from dbus.mainloop.glib import DBusGMainLoop
-DBusGMainLoop(set_as_default=True)
+if state_path is not None:
+    # Saved once more on the way out, after the windows were flushed
+    state_path = os.path.expanduser(state_path)
+    print("Restored state of", restore_state(state_path, listener.beacons), "beacons")
+    core.every(state_interval, lambda: save_state(state_path, listener.beacons))
+    core.on_shutdown(lambda: save_state(state_path, listener.beacons))
 
-bus = dbus.SystemBus()
-proxy = bus.get_object("org.bluez", "/org/bluez/hci0")
-adapter = dbus.Interface(proxy, "org.bluez.Adapter1")
-
-def signal_received_callback(beacon):
-    def signal_received(*args, **kwargs):
-        props = args[1]
-
-        if 'ServiceData' in props and '0000fe95-0000-1000-8000-00805f9b34fb' in props['ServiceData']:
-            # This is a Xiaomi Mija frame ("LYWSD02" sensor). It gives either temperature,
-            # humidity or battery depending on the 11th byte
-            data = props['ServiceData']['0000fe95-0000-1000-8000-00805f9b34fb' ]
-
-            data_type = data[12]
-            if data_type == 0x04:
-                # temperature
-                value = ((data[16] << 8) + data[15]) / 10.0
-                print (value, 'C')
-                headers = {"X-Api-Key": api_key}
-                conn = Request('https://veranda.seos.fr/data/sensor/' + beacon['id'] + '?value=' + str(value), headers=headers)
-                try:
-                    print(urlopen(conn).read())
-                except Exception as e:
-                    print("HTTP error", e)
-
-            elif data_type == 0x06:
-                # humidity
-                value = ((data[16] << 8) + data[15]) / 10.0
-                print (value, '%')
-                headers = {"X-Api-Key": api_key}
-                conn = Request('https://veranda.seos.fr/data/sensor/' + beacon['humidity_id'] + '?value=' + str(value), headers=headers)
-                try:
-                    print(urlopen(conn).read())
-                except Exception as e:
-                    print("HTTP error", e)
-
-            elif data_type == 0x0a:
-                # battery
-                print (data)
-                value = (data[16] << 8) + data[15]
-                print (value, ' battery')
-                beacon['last-battery'] = value
-
-            else:
-                print ("Unknown data type:", data_type)
-                print (data)
-
-        if 'ServiceData' in props and '0000feaa-0000-1000-8000-00805f9b34fb' in props['ServiceData']:
-            # This is an Eddystone frame, it gives us the battery voltage in mV
-            # this might be useful for the APlant devices that give us a soil humidity
-            # value instead of battery in their iBeacon frames
-            # AFAIK, they all run on 3V batteries
-            data = props['ServiceData']['0000feaa-0000-1000-8000-00805f9b34fb' ]
-            voltage_bytes = data[2:4]
-            voltage = (voltage_bytes[0] << 8) + voltage_bytes[1]
-            beacon['last-battery'] = (voltage/3000) * 100
-
-        if 'ManufacturerData' in props and 0x0085 in props['ManufacturerData'] and 'id' in beacon:
-            # This is a SensorBug
-            data = props['ManufacturerData'][0x0085]
-            battery = int(data[3])
-            temperature_bytes = data[-2:]
-            temperature = ((temperature_bytes[1] << 8) + temperature_bytes[0]) * 0.0625
-            temperature = int.from_bytes(temperature_bytes, byteorder='little', signed=False) * 0.0625
-            print(temperature, 'C', battery, '%')
-            headers = {"X-Api-Key": api_key}
-            conn = Request('https://veranda.seos.fr/data/sensor/' + beacon['id'] + '?value=' + str(temperature) + '\&battery=' + str(battery), headers=headers)
-            try:
-                print(urlopen(conn).read())
-            except Exception as e:
-                print("HTTP error", e)
-
-        if 'ManufacturerData' in props and 0x004c in props['ManufacturerData'] and 'id' in beacon:
-            # This is an April Brother thingy (generic iBeacon?)
-            data = props['ManufacturerData'][0x004c]
-            battery = int(data[-3])
-            temperature = int(data[-2])
-            if temperature > 127:
-                temperature = temperature - 0x100
-
-            print(temperature, 'C', battery, '%')
-            headers = {"X-Api-Key": api_key}
-            conn = Request('https://veranda.seos.fr/data/sensor/' + beacon['id'] + '?value=' + str(temperature) + '\&battery=' + str(battery), headers=headers)
-            try:
-                print(urlopen(conn).read())
-            except Exception as e:
-                print("HTTP error", e)
-
-        if 'ManufacturerData' in props and 0x004c in props['ManufacturerData'] and 'humidity_id' in beacon:
-            # This is an April Brother thingy (generic iBeacon?)
-            # This section is for devices that report humidity instead of battery level
-            data = props['ManufacturerData'][0x004c]
-            humidity = int(data[-3])
-            temperature = int(data[-2])
-            if temperature > 127:
-                temperature = temperature - 0x100
-
-            print(temperature, 'C', humidity, '%')
-
-            string = 'value=' + str(humidity)
-            if beacon['last-battery'] > 0:
-                string = string + '\&battery=' + str(beacon['last-battery'])
-
-            headers = {"X-Api-Key": api_key}
-            conn = Request('https://veranda.seos.fr/data/sensor/' + beacon['humidity_id'] + '?' + string, headers=headers)
-            try:
-                print(urlopen(conn).read())
-            except Exception as e:
-                print("HTTP error", e)
-
-        if 'RSSI' in props and 'signal_id' in beacon:
-            signal = int(props['RSSI'])
-            print('Signal strenght:', signal, 'dB')
-            headers = {"X-Api-Key": api_key}
-            conn = Request('https://veranda.seos.fr/data/sensor/' + beacon['signal_id'] + '?value=' + str(signal), headers=headers)
-            try:
-                print(urlopen(conn).read())
-            except Exception as e:
-                print("HTTP error", e)
-
-    return signal_received
-
-for beacon in beacons:
-    device_path = beacon['address'].replace(":", "_").upper()
-    print("Path", device_path, " beacon", beacon)
-    bus.add_signal_receiver(signal_received_callback(beacon), path = "/org/bluez/hci0/dev_" + device_path)
-
-    print('Listening to beacon ', beacon)
-
-def power_off():
-    properties = dbus.Interface(proxy, "org.freedesktop.DBus.Properties")
-
-    print("Powering off")
-    try:
-        properties.Set('org.bluez.Adapter1', 'Powered', False)
-    except Exception as e:
-        print("Could not power off", e)
-
-    check_discovery()
+if capture_path is not None:
+    # Raw signals are written there to be fed to replay.py later on
+    listener.recorder = Recorder(os.path.expanduser(capture_path))
+    core.on_shutdown(listener.recorder.close)
 
-    return 1
+if history_path is not None:
+    listener.history = History(os.path.expanduser(history_path), raw_slots=history_raw_slots)
+    core.on_shutdown(listener.history.close)
 
-def check_discovery():
-    properties = dbus.Interface(proxy, "org.freedesktop.DBus.Properties")
+if mqtt_host is not None:
+    # Uploads to the API are not affected, MQTT comes on top for local
+    # consumers
+    try:
+        listener.publisher = MQTTPublisher(mqtt_host, mqtt_port, mqtt_prefix, mqtt_username, mqtt_password)
+        core.on_shutdown(listener.publisher.close)
+    except RuntimeError as e:
+        print("Not publishing to MQTT:", e)
+
+if gossip_port is not None:
+    # Only the gateway that hears a beacon best uploads it, the others
+    # still decode it, keep its history and publish it locally
+    gossip = Gossip(gateway_name, parse_peers(gossip_peers, int(gossip_port)), int(gossip_port), interval=gossip_interval, failover=gossip_failover)
+    gossip.open()
+    listener.coordinator = gossip
+    core.on_startup(lambda: core.loop.add_reader(gossip.socket, gossip.read))
+    core.every(gossip_interval, gossip.send)
+    core.on_shutdown(gossip.close)
+
+def send_backfill(readings):
+    # As one timestamped batch or not at all, single GETs would not do for
+    # records hours old
+    if not api.batches_supported:
+        raise RuntimeError("the API does not take batches")
+
+    print(api.sensor_values(readings))
+
+if any(beacon.backfill for beacon in listener.beacons):
+    # Hourly records the beacons keep, fetched over GATT when a beacon is
+    # heard again after a gap, listener downtime included
+    backfill = Backfill(bus, listener.beacons, send_backfill, failed=spool_backfill, gap=backfill_gap, concurrency=backfill_concurrency, coordinator=listener.coordinator, adapter_path=adapter_paths[0])
+    core.every(60, backfill.check)
+else:
+    backfill = None
+
+if spool is not None:
+    core.background(lambda: spool.replay_forever(send_readings, batch_size=max(batch_size, 50), rate=spool_replay_rate))
+
+if backfill_spool is not None:
+    core.background(lambda: backfill_spool.replay_forever(send_backfill, batch_size=max(batch_size, 50), rate=spool_replay_rate))
+
+watchdogs = []
+
+def upload_metrics():
+    stats = uploads.stats()
+    metrics = [
+        ('veranda_upload_queue_depth', 'gauge', "Readings waiting to be uploaded", [({}, stats['depth'])]),
+        ('veranda_upload_queued_total', 'counter', "Readings queued for upload", [({}, stats['queued'])]),
+        ('veranda_upload_dropped_total', 'counter', "Readings dropped because the upload queue was full", [({}, stats['dropped'])]),
+        ('veranda_upload_sent_total', 'counter', "Readings uploaded", [({}, stats['sent'])]),
+        ('veranda_upload_failed_total', 'counter', "Readings that failed to upload", [({}, stats['failed'])]),
+        ('veranda_upload_rejected_total', 'counter', "Readings the API rejected for good and that were dropped", [({}, api.rejected)]),
+        ('veranda_http_responses_total', 'counter', "API answers by HTTP status", [({'status': status}, count) for status, count in list(api.responses.items())]),
+        ('veranda_http_request_seconds', 'histogram', "Duration of API requests", api.latency),
+        ('veranda_ble_intake_depth', 'gauge', "Signals waiting to be decoded", [({}, core.intake.qsize() if core.intake is not None else 0)]),
+        ('veranda_ble_intake_dropped_total', 'counter', "Signals dropped because the intake queue was full", [({}, core.dropped_signals)]),
+    ]
+
+    if watchdogs:
+        metrics.append(('veranda_adapter_powered', 'gauge', "Whether the Bluetooth adapter is powered", [({'adapter': watchdog.adapter_path}, int(watchdog.powered)) for watchdog in watchdogs]))
+        metrics.append(('veranda_adapter_discovering', 'gauge', "Whether the Bluetooth adapter is discovering", [({'adapter': watchdog.adapter_path}, int(watchdog.discovering)) for watchdog in watchdogs]))
+        metrics.append(('veranda_adapter_resets_total', 'counter', "Adapter resets done by the watchdog", [({'adapter': watchdog.adapter_path}, watchdog.resets) for watchdog in watchdogs]))
+
+    if listener.publisher is not None:
+        metrics.append(('veranda_mqtt_published_total', 'counter', "Values published to MQTT", [({}, listener.publisher.published)]))
+
+    if spool is not None:
+        stats = spool.stats()
+        metrics.append(('veranda_spool_readings', 'gauge', "Readings waiting in the spool", [({}, stats['spooled'])]))
+        metrics.append(('veranda_spool_replayed_total', 'counter', "Spooled readings uploaded", [({}, stats['replayed'])]))
+        metrics.append(('veranda_spool_discarded_total', 'counter', "Spooled readings dropped because the spool was full", [({}, stats['discarded'])]))
+
+    return metrics
+
+if metrics_port is not None:
+    listener.decode_time = Histogram(DECODE_BUCKETS)
+    api.latency = Histogram(UPLOAD_BUCKETS)
+
+    metrics = Metrics()
+    metrics.add_collector(listener.metrics)
+    metrics.add_collector(upload_metrics)
+    if listener.coordinator is not None:
+        metrics.add_collector(listener.coordinator.metrics)
+    if backfill is not None:
+        metrics.add_collector(backfill.metrics)
+    metrics.serve(int(metrics_port), metrics_address)
+
+last_stats = [time.monotonic(), 0]
+
+def print_stats():
+    # Signals from all devices, configured or not, to see what the
+    # discovery filter saves
+    now = time.monotonic()
+    signals = listener.ignored + sum(beacon.signals for beacon in listener.beacons)
+    rate = (signals - last_stats[1]) / (now - last_stats[0])
+    last_stats[:] = [now, signals]
+
+    print("Upload queue", uploads.stats())
+    if spool is not None:
+        print("Spool", spool.stats())
+        print("Backfill spool", backfill_spool.stats())
+    print("Listener", listener.stats(), "dropped signals", core.dropped_signals, "signals/s %.2f" % rate)
 
-    powered = properties.Get('org.bluez.Adapter1', 'Powered')
-    if not powered:
-        print("Starting power")
-        try:
-            properties.Set('org.bluez.Adapter1', 'Powered', True)
-        except Exception as e:
-            print("Could not power on ", e)
+from gi.repository import GLib
 
-    discovering = properties.Get('org.bluez.Adapter1', 'Discovering')
+if backend == 'hci':
+    # Advertisements are read straight from the controller, bluetoothd
+    # and D-Bus are not involved at all
+    for path in adapter_paths:
+        scanner = HCIScanner(int(path[len("/org/bluez/hci"):]), core.enqueue)
+        scanner.open(active=(scan == 'active'))
+        core.on_startup(lambda scanner=scanner: core.loop.add_reader(scanner.socket, scanner.read))
+        core.on_shutdown(scanner.close)
+else:
+    # One receiver for all devices rather than one per beacon, signals from
+    # devices that are not configured only cost a dict lookup
+    bus.add_signal_receiver(core.properties_changed, bus_name = "org.bluez", dbus_interface = "org.freedesktop.DBus.Properties", signal_name = "PropertiesChanged", path_keyword = "path")
+    bus.add_signal_receiver(core.interfaces_added, bus_name = "org.bluez", dbus_interface = "org.freedesktop.DBus.ObjectManager", signal_name = "InterfacesAdded")
+
+    # Keeps bluetoothd from waking us up for every phone and TV around.
+    # Filtering on UUIDs is left off by default, beacons that only send
+    # manufacturer data (SensorBug, iBeacon) would not get through it
+    uuids = sorted(service_decoders) if filter_uuids else None
+    adapter_filter = discovery_filter(uuids, int(rssi_floor) if rssi_floor is not None else None, duplicate_data)
+
+    if scan == 'passive':
+        print("BlueZ discovery always scans actively, use ble_backend = hci for passive scanning")
+
+    # The adapter is only reset when it stops hearing beacons, rather than
+    # every hour just in case
+    for path in adapter_paths:
+        watchdog = AdapterWatchdog(bus, path, listener.beacons, interval=watchdog_interval, stall_ratio=watchdog_stall_ratio, discovery_filter=adapter_filter)
+        watchdog.start()
+        GLib.timeout_add(int(watchdog_interval * 1000), watchdog.check)
+        watchdogs.append(watchdog)
+
+def reload():
+    # Only beacons that were added, removed or changed in .verandarc are
+    # touched, discovery and uploads carry on as if nothing happened
+    print("Reloading", config_path)
+    try:
+        added, removed = listener.update_beacons(load_beacons(read_config()))
+    except Exception as e:
+        print("Could not reload configuration", e)
+        return
 
-    if not discovering:
-        print("Starting discovery")
-        try:
-            adapter.StartDiscovery()
-        except Exception as e:
-            print("Could not start discovery ", e)
+    for beacon in removed:
+        print('No longer listening to beacon', beacon)
+    for beacon in added:
+        print('Listening to beacon', beacon)
 
-    return 1
+core.on_signal(signal.SIGHUP, reload)
 
-from gi.repository import GLib
+# kill -USR1 starts and stops profiling, kill -USR2 takes memory snapshots
+profiler = Profiler(profile_directory)
+core.on_signal(signal.SIGUSR1, profiler.toggle_profile)
+core.on_signal(signal.SIGUSR2, profiler.snapshot)
 
-power_off()
-GLib.timeout_add(5000, check_discovery)
+if allocations_interval is not None:
+    core.every(float(allocations_interval), profiler.log_allocations)
 
-# have to reset things once in a while for some reason
-GLib.timeout_add(3600 * 1000 + 10, power_off)
+core.every(5, listener.flush_windows)
+core.every(3600, print_stats)
 
-loop = GLib.MainLoop()
-loop.run()
+# The GLib loop only delivers D-Bus signals and runs the watchdogs, from a
+# thread of its own, everything else happens in the asyncio loop
+asyncio.run(core.run(GLib.MainLoop()))
 
@@ -0,0 +1,120 @@
+from filters import DeadbandFilter
+
+# Which .verandarc key gives the API sensor id of each metric of a beacon
+SENSOR_KEYS = {
+    'temperature': 'id',
+    'humidity': 'humidity_id',
+    'signal': 'signal_id',
+}
+
+class Beacon:
+    """
+    State kept for one configured BLE device. There can be a few hundred of
+    these on a gateway, hence the slots.
+    """
+
+    __slots__ = (
+        'name', 'address', 'settings', 'sensors',
+        'signals', 'last_battery', 'mibeacon_counters', 'duplicates',
+        'bindkey', 'cipher', 'backfill', 'last_heard',
+        'filter', 'window', 'aggregator',
+        'adapter', 'elected_adapter', 'adapter_signals', 'adapter_rssi', 'adapter_seen',
+    )
+
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address.upper()
+
+        # The ble_<name>_* keys the beacon was built from, to tell whether its
+        # configuration changed when .verandarc is reloaded
+        self.settings = ()
+
+        # metric name => API sensor id
+        self.sensors = {}
+
+        self.signals = 0
+        self.last_battery = 0
+        self.mibeacon_counters = {}
+        self.duplicates = 0
+
+        # Key of encrypted MiBeacon frames, and the cipher built from it the
+        # first time one comes, kept for the following ones
+        self.bindkey = None
+        self.cipher = None
+
+        # Whether the history the beacon keeps is fetched to fill gaps, and
+        # when it was last heard (wall clock, checked once a minute)
+        self.backfill = False
+        self.last_heard = None
+
+        self.filter = None
+        self.window = None
+        self.aggregator = None
+
+        # With several adapters, `adapter` is the one the beacon is assigned
+        # to in .verandarc. Otherwise the elected one is the adapter that hears
+        # it best, signals coming through the others are ignored
+        self.adapter = None
+        self.elected_adapter = None
+        self.adapter_signals = {}
+        self.adapter_rssi = {}
+        self.adapter_seen = {}
+
+    def device_path(self, adapter_path):
+        return adapter_path + "/dev_" + self.address.replace(":", "_")
+
+    def __repr__(self):
+        return "<Beacon " + self.name + " " + self.address + ">"
+
+def adapter_path(adapter):
+    if adapter.startswith('/'):
+        return adapter
+
+    return '/org/bluez/' + adapter
+
+def load_beacons(config):
+    """
+    Builds the Beacon objects listed in the `ble` key of the .verandarc section
+    `config`, each one being configured by its ble_<name>_* keys.
+    """
+    beacons = []
+
+    for beacon_name in config['ble'].split():
+        prefix = 'ble_' + beacon_name + '_'
+
+        if (prefix + 'address') not in config:
+            continue
+
+        beacon = Beacon(beacon_name, config[prefix + 'address'])
+        beacon.settings = tuple(sorted((key, value) for key, value in config.items() if key.startswith(prefix)))
+
+        for metric, key in SENSOR_KEYS.items():
+            if (prefix + key) in config:
+                beacon.sensors[metric] = config[prefix + key]
+
+        # Devices sending numbered values (Athena boards) get them mapped
+        # through ble_<name>_sensor_<number>_id
+        for key, value in config.items():
+            if key.startswith(prefix + 'sensor_') and key.endswith('_id'):
+                beacon.sensors[key[len(prefix):-len('_id')]] = value
+
+        if (prefix + 'bindkey') in config:
+            beacon.bindkey = bytes.fromhex(config[prefix + 'bindkey'])
+
+        if config.get(prefix + 'backfill') == 'yes':
+            beacon.backfill = True
+
+        if (prefix + 'deadband') in config or (prefix + 'heartbeat') in config:
+            deadband = float(config.get(prefix + 'deadband', 0))
+            heartbeat = float(config.get(prefix + 'heartbeat', 0))
+            beacon.filter = DeadbandFilter(deadband, heartbeat)
+
+        if (prefix + 'window') in config:
+            beacon.window = float(config[prefix + 'window'])
+
+        if (prefix + 'adapter') in config:
+            beacon.adapter = adapter_path(config[prefix + 'adapter'])
+
+        beacons.append(beacon)
+
+    return beacons
@@ -0,0 +1,74 @@
+import gzip
+import json
+import time
+
+class Recorder:
+    """
+    Writes the advertisement related part of the BlueZ signals the listener
+    receives to a gzipped file, one JSON object per line:
+
+        {"t": <monotonic time>, "p": <device path>, "r": <RSSI>,
+         "s": {<service UUID>: <hex data>}, "m": {<company id>: <hex data>}}
+
+    Only the keys present in the signal are written, signals without RSSI,
+    ServiceData or ManufacturerData are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt')
+        self.recorded = 0
+
+    def __call__(self, path, props):
+        record = {}
+
+        if 'RSSI' in props:
+            record['r'] = int(props['RSSI'])
+
+        if 'ServiceData' in props:
+            record['s'] = {str(uuid): bytes(data).hex() for uuid, data in props['ServiceData'].items()}
+
+        if 'ManufacturerData' in props:
+            record['m'] = {str(int(company_id)): bytes(data).hex() for company_id, data in props['ManufacturerData'].items()}
+
+        if not record:
+            return
+
+        record['t'] = round(time.monotonic(), 4)
+        record['p'] = str(path)
+
+        self.file.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self.recorded += 1
+
+        # The listener is usually stopped by being killed, flush now and then
+        # so that a capture is readable up to its last few signals
+        if self.recorded % 100 == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_capture(path):
+    """
+    Yields (time, device path, props) for each signal of a capture file, props
+    being shaped like what dbus-python would hand the listener.
+    """
+    with gzip.open(path, 'rt') as lines:
+        try:
+            for line in lines:
+                record = json.loads(line)
+                props = {}
+
+                if 'r' in record:
+                    props['RSSI'] = record['r']
+
+                if 's' in record:
+                    props['ServiceData'] = {uuid: bytes.fromhex(data) for uuid, data in record['s'].items()}
+
+                if 'm' in record:
+                    props['ManufacturerData'] = {int(company_id): bytes.fromhex(data) for company_id, data in record['m'].items()}
+
+                yield record['t'], record['p'], props
+        except (EOFError, json.JSONDecodeError):
+            # Capture of a listener that was killed, its tail is lost
+            pass
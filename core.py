@@ -0,0 +1,163 @@
+import asyncio
+import signal
+import threading
+
+class ListenerCore:
+    """
+    asyncio core of the beacon listener.
+
+    Signals go into a bounded intake queue, from the D-Bus thread through
+    properties_changed() and interfaces_added(), or from the loop itself
+    through enqueue() for the HCI backend. A task takes them out one by one
+    and hands them to the Listener, which decodes, filters and aggregates them
+    and puts the readings on an AsyncUploadQueue whose workers upload them.
+
+    dbus-python needs a GLib main loop to deliver signals, it runs in a thread
+    of its own and only ever touches the event loop through
+    call_soon_threadsafe().
+
+    On SIGTERM or SIGINT, intake stops, the signals already received are
+    processed, aggregation windows are closed and the upload queue is given
+    `drain_timeout` seconds to empty, what is left going to the spool.
+    """
+
+    def __init__(self, listener, uploads, spool = None, intake_depth = 10000, drain_timeout = 30):
+        self.listener = listener
+        self.uploads = uploads
+        self.spool = spool
+        self.intake_depth = intake_depth
+        self.drain_timeout = drain_timeout
+
+        self.loop = None
+        self.intake = None
+        self.stopping = None
+        self.accepting = False
+        self.dropped_signals = 0
+
+        self.tasks = []
+        self.startup = []
+        self.shutdown_callbacks = []
+
+    # Called from the GLib thread
+
+    def properties_changed(self, interface, changed, invalidated, path = None):
+        if interface == 'org.bluez.Device1':
+            self.forward(path, changed)
+
+    def interfaces_added(self, path, interfaces):
+        if 'org.bluez.Device1' in interfaces:
+            self.forward(path, interfaces['org.bluez.Device1'])
+
+    def forward(self, path, props):
+        # Signals from devices that are not configured stop here, at the
+        # cost of a dict lookup, rather than crossing threads and taking up
+        # room in the intake. The recorder wants them all.
+        if self.listener.recorder is None and path not in self.listener.beacons_by_path:
+            self.listener.ignored += 1
+            return
+
+        self.loop.call_soon_threadsafe(self.enqueue, path, props)
+
+    # Called from the event loop
+
+    def enqueue(self, path, props):
+        if not self.accepting:
+            return
+
+        try:
+            self.intake.put_nowait((path, props))
+        except asyncio.QueueFull:
+            self.dropped_signals += 1
+
+    async def process(self):
+        while True:
+            path, props = await self.intake.get()
+            try:
+                self.listener.signal_received(path, props)
+            except Exception as e:
+                print("Could not handle signal from", path, e)
+            finally:
+                self.intake.task_done()
+
+    def every(self, seconds, function):
+        """
+        Calls function() every `seconds` seconds once the core is running.
+        """
+        async def repeat():
+            while True:
+                await asyncio.sleep(seconds)
+                try:
+                    function()
+                except Exception as e:
+                    print("Error in", function.__name__, e)
+
+        self.startup.append(lambda: self.tasks.append(asyncio.create_task(repeat())))
+
+    def background(self, coroutine_function):
+        """
+        Runs coroutine_function() as a task once the core is running.
+        """
+        self.startup.append(lambda: self.tasks.append(asyncio.create_task(coroutine_function())))
+
+    def on_signal(self, signal_number, function):
+        """
+        Calls function() from the event loop when the process receives
+        signal_number.
+        """
+        self.startup.append(lambda: self.loop.add_signal_handler(signal_number, function))
+
+    def on_startup(self, function):
+        self.startup.append(function)
+
+    def on_shutdown(self, function):
+        self.shutdown_callbacks.append(function)
+
+    def stop(self):
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self, glib_loop = None):
+        self.loop = asyncio.get_running_loop()
+        self.intake = asyncio.Queue(self.intake_depth)
+        self.stopping = asyncio.Event()
+
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signal_number, self.stop)
+
+        self.uploads.start()
+        processing = asyncio.create_task(self.process())
+
+        for function in self.startup:
+            function()
+
+        self.accepting = True
+
+        if glib_loop is not None:
+            threading.Thread(target=glib_loop.run, name="glib", daemon=True).start()
+
+        await self.stopping.wait()
+        print("Stopping")
+
+        self.accepting = False
+        if glib_loop is not None:
+            glib_loop.quit()
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        await self.intake.join()
+        processing.cancel()
+
+        self.listener.flush_windows(force=True)
+
+        left = await self.uploads.drain(self.drain_timeout)
+        if left:
+            if self.spool is not None:
+                print("Spooling", len(left), "readings that could not be uploaded")
+                self.spool.add(left)
+            else:
+                print(len(left), "readings could not be uploaded")
+
+        for function in self.shutdown_callbacks:
+            function()
@@ -0,0 +1,122 @@
+"""
+Measures the cost of decoding one advertisement, comparing the decoder
+registry against the if-chain the listener used before it.
+
+Payloads are what the listener is handed: dbus.Array of dbus.Byte, as
+dbus-python delivers BlueZ signals, when dbus is installed, or bytes, as the
+HCI backend reads them, otherwise. Each case is the best of a few runs.
+
+    python decoder-benchmark.py [iterations]
+"""
+
+import itertools
+import sys
+import timeit
+
+try:
+    import dbus
+except ImportError:
+    dbus = None
+
+from beacons import Beacon
+from decoders import decode
+
+def legacy_decode(beacon, props):
+    readings = []
+
+    if 'ServiceData' in props and '0000fe95-0000-1000-8000-00805f9b34fb' in props['ServiceData']:
+        data = props['ServiceData']['0000fe95-0000-1000-8000-00805f9b34fb' ]
+
+        data_type = data[12]
+        if data_type == 0x04:
+            value = ((data[16] << 8) + data[15]) / 10.0
+            readings.append(('temperature', value, None))
+
+        elif data_type == 0x06:
+            value = ((data[16] << 8) + data[15]) / 10.0
+            readings.append(('humidity', value, None))
+
+        elif data_type == 0x0a:
+            value = (data[16] << 8) + data[15]
+            beacon.last_battery = value
+
+    if 'ServiceData' in props and '0000feaa-0000-1000-8000-00805f9b34fb' in props['ServiceData']:
+        data = props['ServiceData']['0000feaa-0000-1000-8000-00805f9b34fb' ]
+        voltage_bytes = data[2:4]
+        voltage = (voltage_bytes[0] << 8) + voltage_bytes[1]
+        beacon.last_battery = (voltage/3000) * 100
+
+    if 'ManufacturerData' in props and 0x0085 in props['ManufacturerData'] and 'temperature' in beacon.sensors:
+        data = props['ManufacturerData'][0x0085]
+        battery = int(data[3])
+        temperature_bytes = data[-2:]
+        temperature = ((temperature_bytes[1] << 8) + temperature_bytes[0]) * 0.0625
+        temperature = int.from_bytes(temperature_bytes, byteorder='little', signed=False) * 0.0625
+        readings.append(('temperature', temperature, battery))
+
+    if 'ManufacturerData' in props and 0x004c in props['ManufacturerData'] and 'temperature' in beacon.sensors:
+        data = props['ManufacturerData'][0x004c]
+        battery = int(data[-3])
+        temperature = int(data[-2])
+        if temperature > 127:
+            temperature = temperature - 0x100
+        readings.append(('temperature', temperature, battery))
+
+    if 'ManufacturerData' in props and 0x004c in props['ManufacturerData'] and 'humidity' in beacon.sensors:
+        data = props['ManufacturerData'][0x004c]
+        humidity = int(data[-3])
+        temperature = int(data[-2])
+        if temperature > 127:
+            temperature = temperature - 0x100
+        battery = None
+        if beacon.last_battery > 0:
+            battery = beacon.last_battery
+        readings.append(('humidity', humidity, battery))
+
+    return readings
+
+def payload(values):
+    if dbus is not None:
+        return dbus.Array([dbus.Byte(value) for value in values], signature='y')
+
+    return bytes(values)
+
+def mibeacon_frames():
+    # Same measurement with a new frame counter every time, so that the
+    # duplicate suppression does not short-circuit the decoding
+    frames = []
+    for counter in range(256):
+        frames.append({'ServiceData': {'0000fe95-0000-1000-8000-00805f9b34fb': payload([0x70, 0x20, 0x5b, 0x04, counter, 0x4c, 0x4b, 0x3a, 0x38, 0xc1, 0xa4, 0x09, 0x04, 0x10, 0x02, 0xd2, 0x00])}})
+
+    return itertools.cycle(frames)
+
+SAMPLES = {
+    'sensorbug': {'ManufacturerData': {0x0085: payload([0x02, 0x00, 0x3c, 0x55, 0x00, 0x00, 0x43, 0x01, 0x5d, 0x01])}},
+    'ibeacon': {'ManufacturerData': {0x004c: payload([0x02, 0x15] + [0xaa] * 16 + [0x00, 0x01, 0x00, 0x02, 0x3b, 0xe9, 0xc5])}},
+    'eddystone': {'ServiceData': {'0000feaa-0000-1000-8000-00805f9b34fb': payload([0x20, 0x00, 0x0b, 0xb8, 0x00, 0x00])}},
+}
+
+def best(function, iterations, repeat = 5):
+    return min(timeit.repeat(function, number=iterations, repeat=repeat)) / iterations
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    beacon = Beacon('benchmark', '00:00:00:00:00:00')
+    beacon.sensors = {'temperature': '1', 'humidity': '2'}
+
+    frames = mibeacon_frames()
+    cases = dict(SAMPLES)
+
+    print("Payloads as", "dbus.Array" if dbus is not None else "bytes (dbus is not installed)")
+
+    for name in ['mibeacon'] + list(cases):
+        if name == 'mibeacon':
+            before = best(lambda: legacy_decode(beacon, next(frames)), iterations)
+            after = best(lambda: decode(beacon, next(frames)), iterations)
+        else:
+            props = cases[name]
+            before = best(lambda: legacy_decode(beacon, props), iterations)
+            after = best(lambda: decode(beacon, props), iterations)
+
+        print("%-10s before %6.2f us  after %6.2f us" % (name, before * 1e6, after * 1e6))
@@ -0,0 +1,256 @@
+import struct
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESCCM
+except ImportError:
+    AESCCM = None
+
+# Decoders for the advertisement payloads we know about, keyed by full service
+# UUID for ServiceData and by company identifier for ManufacturerData.
+#
+# A decoder is called as decoder(beacon, data) with data as bytes, it can
+# update the beacon's state and returns a list of (metric, value, battery)
+# tuples, battery being None when the frame does not carry it.
+service_decoders = {}
+manufacturer_decoders = {}
+
+def uuid16(short_uuid):
+    return '0000%04x-0000-1000-8000-00805f9b34fb' % short_uuid
+
+def service_data(short_uuid):
+    def register(decoder):
+        service_decoders[uuid16(short_uuid)] = decoder
+        return decoder
+
+    return register
+
+def manufacturer_data(company_id):
+    def register(decoder):
+        manufacturer_decoders[company_id] = decoder
+        return decoder
+
+    return register
+
+def decode(beacon, props):
+    readings = []
+
+    # dbus.String and dbus.UInt16 keys hash like str and int, no need to
+    # convert them before the lookups. Payloads from the HCI backend are
+    # bytes already, only dbus.Array ones need converting.
+    service_data = props.get('ServiceData')
+    if service_data:
+        for uuid, data in service_data.items():
+            decoder = service_decoders.get(uuid)
+            if decoder is not None:
+                readings += decoder(beacon, data if type(data) is bytes else bytes(data))
+
+    manufacturer_data = props.get('ManufacturerData')
+    if manufacturer_data:
+        for company_id, data in manufacturer_data.items():
+            decoder = manufacturer_decoders.get(company_id)
+            if decoder is not None:
+                readings += decoder(beacon, data if type(data) is bytes else bytes(data))
+
+    return readings
+
+MIBEACON = struct.Struct('<4xB7xB2xh')
+MIBEACON_HEADER = struct.Struct('<HHB')
+MIBEACON_OBJECT = struct.Struct('<HB')
+
+MIBEACON_ENCRYPTED = 0x08
+MIBEACON_MAC_INCLUDED = 0x10
+MIBEACON_CAPABILITY_INCLUDED = 0x20
+MIBEACON_IO_CAPABILITY = 0x20
+
+# Object type => (struct, metrics), for the objects found in encrypted frames
+MIBEACON_OBJECTS = {
+    0x1004: (struct.Struct('<h'), (('temperature', 0.1),)),
+    0x1006: (struct.Struct('<H'), (('humidity', 0.1),)),
+    0x100a: (struct.Struct('<B'), (('battery', 1),)),
+    0x100d: (struct.Struct('<hH'), (('temperature', 0.1), ('humidity', 0.1))),
+    0x4803: (struct.Struct('<B'), (('battery', 1),)),
+    0x4c01: (struct.Struct('<f'), (('temperature', 1),)),
+    0x4c02: (struct.Struct('<B'), (('humidity', 1),)),
+}
+
+def mibeacon_cipher(beacon):
+    if beacon.cipher is None:
+        # The nonce starts with the MAC address, least significant byte first
+        address = bytes.fromhex(beacon.address.replace(':', ''))[::-1]
+        beacon.cipher = (AESCCM(beacon.bindkey, tag_length=4), address)
+
+    return beacon.cipher
+
+def decode_encrypted_mibeacon(beacon, data, frame_control):
+    # MiBeacon v4/v5 as sent by newer Xiaomi sensors: the objects are
+    # encrypted with AES-CCM, the frame ending with a 3 byte extension of the
+    # frame counter and a 4 byte tag
+    if frame_control >> 12 < 4:
+        return []
+
+    if beacon.bindkey is None:
+        return []
+
+    offset = MIBEACON_HEADER.size
+    if frame_control & MIBEACON_MAC_INCLUDED:
+        offset += 6
+
+    if frame_control & MIBEACON_CAPABILITY_INCLUDED:
+        if len(data) <= offset:
+            return []
+        if data[offset] & MIBEACON_IO_CAPABILITY:
+            offset += 1
+        offset += 1
+
+    # At least one object header, the counter extension and the tag
+    if len(data) < offset + 3 + 7:
+        return []
+
+    if AESCCM is None:
+        print("Encrypted frame from", beacon.name, "but cryptography is not installed, ignoring its bindkey")
+        beacon.bindkey = None
+        return []
+
+    cipher, address = mibeacon_cipher(beacon)
+    nonce = address + data[2:5] + data[-7:-4]
+
+    try:
+        payload = cipher.decrypt(nonce, data[offset:-7] + data[-4:], b"\x11")
+    except Exception:
+        print("Could not decrypt frame from", beacon.name, "wrong bindkey?")
+        return []
+
+    readings = []
+    offset = 0
+    while offset + MIBEACON_OBJECT.size <= len(payload):
+        object_type, length = MIBEACON_OBJECT.unpack_from(payload, offset)
+        offset += MIBEACON_OBJECT.size
+
+        decoder = MIBEACON_OBJECTS.get(object_type)
+        if decoder is not None and decoder[0].size <= length <= len(payload) - offset:
+            values = decoder[0].unpack_from(payload, offset)
+            for (metric, scale), value in zip(decoder[1], values):
+                if metric == 'battery':
+                    beacon.last_battery = value
+                else:
+                    readings.append((metric, value * scale, None))
+
+        offset += length
+
+    return readings
+
+@service_data(0xfe95)
+def decode_mibeacon(beacon, data):
+    # This is a Xiaomi Mija frame ("LYWSD02" sensor). It gives either temperature,
+    # humidity or battery depending on the 13th byte
+    if len(data) < MIBEACON_HEADER.size:
+        return []
+
+    # The encryption flag is in the low byte of the frame control, plain
+    # frames have no use for the rest of the header
+    if data[0] & MIBEACON_ENCRYPTED:
+        frame_control, product_id, counter = MIBEACON_HEADER.unpack_from(data)
+        # Repeats are told apart before decrypting anything, all encrypted
+        # frames share the counter of object type 0
+        if beacon.mibeacon_counters.get(0) == counter:
+            beacon.duplicates += 1
+            return []
+        beacon.mibeacon_counters[0] = counter
+
+        return decode_encrypted_mibeacon(beacon, data, frame_control)
+
+    if len(data) < MIBEACON.size:
+        return []
+
+    frame_counter, data_type, value = MIBEACON.unpack_from(data)
+
+    # The same frame is sent many times in a row, only its 5th byte (the
+    # frame counter) changes when there is a new measurement
+    duplicate = beacon.mibeacon_counters.get(data_type) == frame_counter
+    beacon.mibeacon_counters[data_type] = frame_counter
+
+    if duplicate:
+        beacon.duplicates += 1
+        return []
+
+    if data_type == 0x04:
+        return [('temperature', value / 10.0, None)]
+
+    elif data_type == 0x06:
+        return [('humidity', value / 10.0, None)]
+
+    elif data_type == 0x0a:
+        beacon.last_battery = value
+        return []
+
+    print("Unknown data type:", data_type)
+    print(data)
+    return []
+
+EDDYSTONE_TLM = struct.Struct('>2xH')
+
+@service_data(0xfeaa)
+def decode_eddystone(beacon, data):
+    # This is an Eddystone frame, it gives us the battery voltage in mV
+    # this might be useful for the APlant devices that give us a soil humidity
+    # value instead of battery in their iBeacon frames
+    # AFAIK, they all run on 3V batteries
+    if len(data) < EDDYSTONE_TLM.size:
+        return []
+
+    voltage, = EDDYSTONE_TLM.unpack_from(data)
+    beacon.last_battery = (voltage/3000) * 100
+    return []
+
+SENSORBUG_BATTERY = struct.Struct('<3xB')
+SENSORBUG_TEMPERATURE = struct.Struct('<H')
+
+@manufacturer_data(0x0085)
+def decode_sensorbug(beacon, data):
+    # This is a SensorBug
+    if len(data) < SENSORBUG_BATTERY.size + SENSORBUG_TEMPERATURE.size:
+        return []
+
+    battery, = SENSORBUG_BATTERY.unpack_from(data)
+    temperature, = SENSORBUG_TEMPERATURE.unpack_from(data, len(data) - SENSORBUG_TEMPERATURE.size)
+    return [('temperature', temperature * 0.0625, battery)]
+
+IBEACON_TRAILER = struct.Struct('<Bbx')
+
+@manufacturer_data(0x004c)
+def decode_ibeacon(beacon, data):
+    # This is an April Brother thingy (generic iBeacon?). Some of them report
+    # humidity instead of battery level, which one we get depends on what
+    # sensor ids the beacon has
+    if len(data) < IBEACON_TRAILER.size:
+        return []
+
+    level, temperature = IBEACON_TRAILER.unpack_from(data, len(data) - IBEACON_TRAILER.size)
+
+    readings = []
+
+    if 'temperature' in beacon.sensors:
+        readings.append(('temperature', temperature, level))
+
+    if 'humidity' in beacon.sensors:
+        battery = None
+        if beacon.last_battery > 0:
+            battery = beacon.last_battery
+
+        readings.append(('humidity', level, battery))
+
+    return readings
+
+ATHENA_VALUE = struct.Struct('<Be')
+
+@manufacturer_data(0x1789)
+def decode_athena(beacon, data):
+    # Telemetry from our own Athena boards (see BLE.broadcast_values in
+    # athena/lib/ble.py): a count, then that many (sensor number, half float)
+    # pairs. The firmware announces the AD structure one byte short, so the
+    # last pair usually comes truncated and is skipped
+    if len(data) < 1:
+        return []
+
+    count = min(data[0], (len(data) - 1) // ATHENA_VALUE.size)
+    return [('sensor_%d' % number, value, None) for number, value in ATHENA_VALUE.iter_unpack(data[1:1 + count * ATHENA_VALUE.size])]
@@ -0,0 +1,124 @@
+import time
+
+class DeadbandFilter:
+    """
+    Lets a value through only when it moved by more than `deadband` from the
+    last value let through for the same sensor, or when `heartbeat` seconds
+    have passed since then, so that the server still hears from a sensor
+    whose value does not change.
+
+    A heartbeat of 0 means no heartbeat: unchanged values are never repeated.
+    """
+
+    def __init__(self, deadband = 0, heartbeat = 0):
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self.last = {}
+        self.suppressed = 0
+
+    def accept(self, sensor_id, value, now = None):
+        if now is None:
+            now = time.monotonic()
+
+        if sensor_id in self.last:
+            last_value, last_time = self.last[sensor_id]
+            moved = abs(value - last_value) > self.deadband
+            expired = self.heartbeat > 0 and now - last_time >= self.heartbeat
+
+            if not moved and not expired:
+                self.suppressed += 1
+                return False
+
+        self.last[sensor_id] = (value, now)
+        return True
+
+class Window:
+    __slots__ = ('start', 'count', 'minimum', 'maximum', 'total', 'last', 'battery', 'time')
+
+    def __init__(self):
+        self.count = 0
+
+    def reset(self, start):
+        self.start = start
+        self.count = 0
+        self.total = 0
+        self.battery = None
+
+    def add(self, value, battery, now):
+        if self.count == 0:
+            self.minimum = value
+            self.maximum = value
+        else:
+            self.minimum = min(self.minimum, value)
+            self.maximum = max(self.maximum, value)
+
+        self.count += 1
+        self.total += value
+        self.last = value
+        self.time = now
+
+        if battery is not None:
+            self.battery = battery
+
+    def mean(self):
+        return self.total / self.count
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'min': self.minimum,
+            'max': self.maximum,
+            'mean': self.mean(),
+            'last': self.last,
+        }
+
+class WindowAggregator:
+    """
+    Accumulates the values of each sensor over windows of `length` seconds
+    and calls emit(sensor_id, window) once per window when it closes, so that
+    a sensor advertising every second gives one upload per window while its
+    extremes are kept.
+
+    A window closes when a value arrives after its end or, for sensors that
+    went silent, when flush() is called after its end. Each sensor has one
+    Window object that is reset in place, nothing grows with the number of
+    values.
+    """
+
+    def __init__(self, length, emit):
+        self.length = length
+        self.emit = emit
+        self.windows = {}
+
+    def add(self, sensor_id, value, battery = None, now = None):
+        if now is None:
+            now = time.monotonic()
+
+        window = self.windows.get(sensor_id)
+        if window is None:
+            window = Window()
+            self.windows[sensor_id] = window
+
+        if window.count > 0 and now - window.start >= self.length:
+            self.close(sensor_id, window)
+
+        if window.count == 0:
+            window.reset(now)
+
+        window.add(value, battery, time.time())
+
+    def close(self, sensor_id, window):
+        try:
+            self.emit(sensor_id, window)
+        finally:
+            window.count = 0
+
+    def flush(self, now = None, force = False):
+        if now is None:
+            now = time.monotonic()
+
+        for sensor_id, window in self.windows.items():
+            if window.count > 0 and (force or now - window.start >= self.length):
+                self.close(sensor_id, window)
+
+        return True
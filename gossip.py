@@ -0,0 +1,169 @@
+import json
+import socket
+import time
+
+class Gossip:
+    """
+    Coordination between listeners whose radio ranges overlap, so that each
+    beacon is uploaded by one of them only.
+
+    Every `interval` seconds, each gateway sends its peers how well it hears
+    each beacon: the smoothed RSSI, how long ago it last heard it and whether
+    it is the one uploading it, over UDP. For each beacon, the gateway that
+    hears it best is elected to upload its readings, ties going to the first
+    name. A gateway that says it uploads a beacon keeps doing so until another
+    one hears it better by `hysteresis` dB, or until it has not heard it (or
+    has not been heard from) for `failover` seconds.
+
+    The election is worked out afresh from the values as gossiped, a
+    gateway's own included, and nothing else, so that every gateway comes to
+    the same result once it has the others' latest messages. Until both a
+    peer and the gateway itself have gossiped about a beacon, the gateway
+    uploads it. In between two rounds, a handover can leave a beacon uploaded
+    twice, or not at all, for up to `interval` seconds.
+    """
+
+    def __init__(self, name, peers, port, interval = 5, hysteresis = 5, failover = 120):
+        self.name = name
+        self.peers = peers
+        self.port = port
+        self.interval = interval
+        self.hysteresis = hysteresis
+        self.failover = failover
+
+        # beacon name => (rssi, monotonic time last heard), as heard here
+        self.own = {}
+
+        # beacon name => {gateway name: (rssi, monotonic time last heard,
+        # whether it uploads the beacon)}, as gossiped by every gateway, this
+        # one included
+        self.hearing = {}
+
+        # beacon name => gateway elected the last time elected() was called
+        self.elected_gateways = {}
+
+        self.sent = 0
+        self.received = 0
+        self.socket = None
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.bind(('', self.port))
+        self.socket.setblocking(False)
+        return self.socket
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def heard(self, beacon, props):
+        if 'RSSI' not in props:
+            return
+
+        rssi = int(props['RSSI'])
+        previous = self.own.get(beacon.name)
+        if previous is not None:
+            rssi = 0.8 * previous[0] + 0.2 * rssi
+
+        self.own[beacon.name] = (rssi, time.monotonic())
+
+    def send(self):
+        now = time.monotonic()
+        beacons = {}
+        for beacon_name, (rssi, last_heard) in self.own.items():
+            rssi = round(rssi, 1)
+            age = round(now - last_heard, 1)
+            uploading = self.elected_gateways.get(beacon_name) == self.name
+            beacons[beacon_name] = (rssi, age, uploading)
+
+            # Elections here use what the peers are told, not the live value
+            self.hearing.setdefault(beacon_name, {})[self.name] = (rssi, now - age, uploading)
+
+        # Ages rather than times, the clocks of the gateways need not agree
+        message = json.dumps({'gateway': self.name, 'beacons': beacons}, separators=(',', ':')).encode()
+
+        for peer in self.peers:
+            try:
+                self.socket.sendto(message, peer)
+                self.sent += 1
+            except OSError as e:
+                print("Could not send gossip to", peer, e)
+
+        return True
+
+    def read(self, *args):
+        try:
+            message, address = self.socket.recvfrom(65536)
+            message = json.loads(message)
+        except (OSError, ValueError) as e:
+            print("Could not read gossip", e)
+            return True
+
+        gateway = message.get('gateway')
+        if gateway is None or gateway == self.name:
+            # Our own broadcast coming back
+            return True
+
+        now = time.monotonic()
+        for beacon_name, (rssi, age, uploading) in message.get('beacons', {}).items():
+            self.hearing.setdefault(beacon_name, {})[gateway] = (rssi, now - age, uploading)
+
+        self.received += 1
+        return True
+
+    def elected(self, beacon):
+        """
+        Tells whether this gateway should upload the readings of beacon.
+        """
+        now = time.monotonic()
+        heard = {gateway: (rssi, uploading) for gateway, (rssi, last_heard, uploading) in self.hearing.get(beacon.name, {}).items() if now - last_heard <= self.failover}
+
+        if self.name not in heard or len(heard) < 2:
+            # Nobody else hears it, or we did not tell them we do yet: there
+            # is nothing to elect, and electing now would be done on values
+            # the others do not have
+            if self.name in heard:
+                self.elected_gateways[beacon.name] = self.name
+            return True
+
+        # Highest RSSI, then first name, for every gateway to pick the same one
+        def rank(gateway):
+            return (-heard[gateway][0], gateway)
+
+        elected = min(heard, key=rank)
+
+        # Hysteresis only ever applies to what the gateways said, never to
+        # an election remembered here, which the others know nothing about
+        uploaders = [gateway for gateway in heard if heard[gateway][1]]
+        if uploaders:
+            uploader = min(uploaders, key=rank)
+            if heard[elected][0] <= heard[uploader][0] + self.hysteresis:
+                elected = uploader
+
+        previous = self.elected_gateways.get(beacon.name)
+        if previous is not None and previous != elected:
+            print(beacon.name, "now uploaded by", elected)
+        self.elected_gateways[beacon.name] = elected
+
+        return elected == self.name
+
+    def metrics(self):
+        return [
+            ('veranda_gossip_sent_total', 'counter', "Gossip messages sent to other gateways", [({}, self.sent)]),
+            ('veranda_gossip_received_total', 'counter', "Gossip messages received from other gateways", [({}, self.received)]),
+            ('veranda_gossip_elected_beacons', 'gauge', "Beacons this gateway uploads", [({}, sum(1 for gateway in self.elected_gateways.values() if gateway == self.name))]),
+        ]
+
+def parse_peers(peers, port):
+    """
+    Turns "host[:port] ..." into a list of addresses, a broadcast address
+    such as 192.168.1.255 reaching every gateway on the network.
+    """
+    addresses = []
+    for peer in peers.split():
+        host, _, peer_port = peer.partition(':')
+        addresses.append((host, int(peer_port or port)))
+
+    return addresses
@@ -0,0 +1,160 @@
+import socket
+import struct
+
+from decoders import uuid16
+
+# Raw HCI scanning backend: instead of going through bluetoothd and D-Bus,
+# the listener can open an HCI socket, enable LE scanning itself and parse
+# the advertising reports straight from the controller. Needs CAP_NET_RAW.
+
+HCI_COMMAND_PKT = 0x01
+HCI_EVENT_PKT = 0x04
+
+EVT_CMD_COMPLETE = 0x0e
+EVT_CMD_STATUS = 0x0f
+EVT_LE_META_EVENT = 0x3e
+EVT_LE_ADVERTISING_REPORT = 0x02
+
+OGF_LE_CTL = 0x08
+OCF_LE_SET_SCAN_PARAMETERS = 0x000b
+OCF_LE_SET_SCAN_ENABLE = 0x000c
+
+SOL_HCI = 0
+HCI_FILTER = 2
+
+AD_SERVICE_DATA_16 = 0x16
+AD_MANUFACTURER_DATA = 0xff
+
+ADVERTISING_REPORT = struct.Struct('<BB6sB')
+UINT16 = struct.Struct('<H')
+
+def command(ogf, ocf, parameters = b''):
+    return struct.pack('<BHB', HCI_COMMAND_PKT, (ogf << 10) | ocf, len(parameters)) + parameters
+
+def format_address(address):
+    # Addresses come least significant byte first
+    return ':'.join('%02X' % byte for byte in reversed(address))
+
+def parse_advertising_data(data):
+    """
+    Turns the AD structures of an advertisement into a dict shaped like the
+    properties BlueZ would give us, so that the same decoders apply.
+    """
+    props = {}
+    offset = 0
+
+    while offset < len(data):
+        length = data[offset]
+        if length == 0 or offset + 1 + length > len(data):
+            break
+
+        ad_type = data[offset + 1]
+        value = data[offset + 2:offset + 1 + length]
+
+        if ad_type == AD_SERVICE_DATA_16 and len(value) >= 2:
+            uuid, = UINT16.unpack_from(value)
+            props.setdefault('ServiceData', {})[uuid16(uuid)] = value[2:]
+
+        elif ad_type == AD_MANUFACTURER_DATA and len(value) >= 2:
+            company_id, = UINT16.unpack_from(value)
+            props.setdefault('ManufacturerData', {})[company_id] = value[2:]
+
+        offset += 1 + length
+
+    return props
+
+def parse_event(packet):
+    """
+    Yields (address, props) for every advertising report of an HCI event
+    packet, nothing for other events.
+    """
+    if len(packet) < 5 or packet[0] != HCI_EVENT_PKT or packet[1] != EVT_LE_META_EVENT or packet[3] != EVT_LE_ADVERTISING_REPORT:
+        return
+
+    reports = packet[4]
+    offset = 5
+
+    for i in range(reports):
+        if offset + ADVERTISING_REPORT.size > len(packet):
+            return
+
+        event_type, address_type, address, length = ADVERTISING_REPORT.unpack_from(packet, offset)
+        offset += ADVERTISING_REPORT.size
+
+        if offset + length + 1 > len(packet):
+            return
+
+        props = parse_advertising_data(packet[offset:offset + length])
+        offset += length
+
+        rssi = packet[offset]
+        if rssi > 127:
+            rssi -= 256
+        offset += 1
+
+        if rssi != 127:
+            # 127 means the controller had no RSSI for it
+            props['RSSI'] = rssi
+
+        yield format_address(address), props
+
+class HCIScanner:
+    """
+    Passive LE scanner on hci<device>. Each advertising report is handed to
+    callback(device path, props), the device path being the one BlueZ would
+    have used so that the listener does not see the difference.
+    """
+
+    def __init__(self, device, callback):
+        self.device = device
+        self.adapter_path = '/org/bluez/hci' + str(device)
+        self.callback = callback
+        self.socket = None
+        self.paths = {}
+
+    def open(self, active = False, interval = 0x0010, window = 0x0010):
+        self.socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        self.socket.bind((self.device,))
+
+        # LE meta events for the advertising reports, and the answers to our
+        # commands, which are let through but neither waited for nor parsed
+        event_mask = (1 << EVT_CMD_COMPLETE) | (1 << EVT_CMD_STATUS)
+        hci_filter = struct.pack('<IIIH', 1 << HCI_EVENT_PKT, event_mask, 1 << (EVT_LE_META_EVENT - 32), 0)
+        self.socket.setsockopt(SOL_HCI, HCI_FILTER, hci_filter)
+
+        self.socket.send(command(OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0)))
+        self.socket.send(command(OGF_LE_CTL, OCF_LE_SET_SCAN_PARAMETERS, struct.pack('<BHHBB', int(active), interval, window, 0, 0)))
+        self.socket.send(command(OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 1, 0)))
+
+        return self.socket
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.send(command(OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, struct.pack('<BB', 0, 0)))
+            finally:
+                self.socket.close()
+                self.socket = None
+
+    def device_path(self, address):
+        path = self.paths.get(address)
+        if path is None:
+            # Phones around change address all the time, don't let that grow forever
+            if len(self.paths) > 4096:
+                self.paths.clear()
+
+            path = self.adapter_path + '/dev_' + address.replace(':', '_')
+            self.paths[address] = path
+
+        return path
+
+    def handle_packet(self, packet):
+        for address, props in parse_event(packet):
+            self.callback(self.device_path(address), props)
+
+    def read(self, *args):
+        """
+        Reads one packet from the socket, usable as a GLib IO watch callback.
+        """
+        self.handle_packet(self.socket.recv(260))
+        return True
@@ -0,0 +1,79 @@
+"""
+Queries the local history kept by the listener (see ble_history in
+.verandarc).
+
+    python history-query.py [--history ~/.veranda-history] --list
+    python history-query.py 11 [--from 2h] [--to now] [--resolution 1m]
+
+Times are either Unix timestamps, "now", or durations before now such as
+90s, 15m, 2h or 30d. Without --resolution, the finest one that still covers
+--from is used: raw values as far back as the raw ring goes (its size is set
+by ble_history_raw_slots), then minutes for 30 days, then hours.
+"""
+
+import argparse
+import configparser
+import itertools
+import os
+import sys
+import time
+
+from history import History
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_time(text, now):
+    if text == 'now':
+        return now
+
+    if text[-1:] in UNITS:
+        return now - float(text[:-1]) * UNITS[text[-1]]
+
+    return float(text)
+
+def default_history():
+    try:
+        config = configparser.ConfigParser()
+        with open(os.getenv('HOME') + '/.verandarc') as lines:
+            config.read_file(itertools.chain(("[root]",), lines))
+        return config['root'].get('ble_history', '~/.veranda-history')
+    except OSError:
+        return '~/.veranda-history'
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries the history kept by the beacon listener")
+    parser.add_argument('sensor', nargs='?', help="sensor id")
+    parser.add_argument('--history', help="history directory, ble_history from ~/.verandarc by default")
+    parser.add_argument('--list', action='store_true', help="list the sensors in the history")
+    parser.add_argument('--from', dest='start', default='24h')
+    parser.add_argument('--to', dest='end', default='now')
+    parser.add_argument('--resolution', choices=('raw', '1m', '1h'))
+    arguments = parser.parse_args()
+
+    history = History(os.path.expanduser(arguments.history or default_history()), writable=False)
+
+    if arguments.list:
+        for sensor_id in history.sensor_ids():
+            print(sensor_id)
+        return
+
+    if arguments.sensor is None:
+        parser.error("a sensor id or --list is needed")
+
+    if arguments.sensor not in history.sensor_ids():
+        print("No history for sensor", arguments.sensor, file=sys.stderr)
+        return 1
+
+    now = time.time()
+    started = time.perf_counter()
+    values = history.query(arguments.sensor, parse_time(arguments.start, now), parse_time(arguments.end, now), arguments.resolution)
+    elapsed = time.perf_counter() - started
+
+    for when, mean, minimum, maximum, count in values:
+        print("%s\t%g\t%g\t%g\t%d" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)), mean, minimum, maximum, count))
+
+    print("%d values in %.1f ms" % (len(values), elapsed * 1000), file=sys.stderr)
+    history.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
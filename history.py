@@ -0,0 +1,210 @@
+import mmap
+import os
+import struct
+import time
+
+# Local history of the values decoded by the listener, so that recent data
+# can be looked at on the gateway itself.
+#
+# Each sensor has one file per tier, of a fixed size and memory-mapped:
+#
+#  - <sensor>.raw holds the last `raw_slots` values as they came, in a ring
+#    after a header giving the number of values ever written,
+#  - <sensor>.1m and <sensor>.1h hold count, mean, min and max per minute
+#    (30 days) and per hour (5 years), the slot of a bucket being its number
+#    modulo the number of slots, so that old buckets are simply overwritten.
+
+RAW_HEADER = struct.Struct('<Q')
+RAW_RECORD = struct.Struct('<dd')
+BUCKET_RECORD = struct.Struct('<dIddd')
+
+# name, bucket length in seconds, slots
+TIERS = (
+    ('1m', 60, 30 * 24 * 60),
+    ('1h', 3600, 5 * 366 * 24),
+)
+
+def open_map(path, size, writable):
+    if writable:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+
+class RawRing:
+    """
+    Ring of (time, value) records, oldest first from `head`. Values are
+    expected to come in time order, which lets range() bisect the ring.
+    """
+
+    def __init__(self, path, slots, writable = True):
+        self.slots = slots
+        self.map = open_map(path, RAW_HEADER.size + slots * RAW_RECORD.size, writable)
+
+    def written(self):
+        return RAW_HEADER.unpack_from(self.map)[0]
+
+    def add(self, when, value):
+        written = self.written()
+        RAW_RECORD.pack_into(self.map, RAW_HEADER.size + (written % self.slots) * RAW_RECORD.size, when, value)
+        RAW_HEADER.pack_into(self.map, 0, written + 1)
+
+    def record(self, index):
+        # index 0 is the oldest value still in the ring
+        written = self.written()
+        first = max(0, written - self.slots)
+        return RAW_RECORD.unpack_from(self.map, RAW_HEADER.size + ((first + index) % self.slots) * RAW_RECORD.size)
+
+    def covers(self, start):
+        """
+        Tells whether the ring still holds every value since start, the ring
+        holding a number of values rather than a duration: a few hours of a
+        signal sensor, weeks of a quiet one.
+        """
+        written = self.written()
+        return written < self.slots or self.record(0)[0] <= start
+
+    def range(self, start, end):
+        count = min(self.written(), self.slots)
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < start:
+                low = middle + 1
+            else:
+                high = middle
+
+        values = []
+        for index in range(low, count):
+            when, value = self.record(index)
+            if when >= end:
+                break
+            values.append((when, value, value, value, 1))
+
+        return values
+
+    def close(self):
+        self.map.close()
+
+class BucketRing:
+    """
+    Per bucket count, mean, min and max, one slot per bucket.
+    """
+
+    def __init__(self, path, length, slots, writable = True):
+        self.length = length
+        self.slots = slots
+        self.map = open_map(path, slots * BUCKET_RECORD.size, writable)
+
+    def add(self, when, value):
+        bucket = int(when // self.length)
+        offset = (bucket % self.slots) * BUCKET_RECORD.size
+        start, count, total, minimum, maximum = BUCKET_RECORD.unpack_from(self.map, offset)
+
+        if count == 0 or start != bucket * self.length:
+            # Empty slot, or one left over from `slots` buckets ago
+            BUCKET_RECORD.pack_into(self.map, offset, bucket * self.length, 1, value, value, value)
+        else:
+            BUCKET_RECORD.pack_into(self.map, offset, start, count + 1, total + value, min(minimum, value), max(maximum, value))
+
+    def range(self, start, end):
+        values = []
+        first = int(start // self.length)
+        last = int((end - 1) // self.length)
+
+        # Nothing older than `slots` buckets can still be there
+        first = max(first, last - self.slots + 1)
+
+        for bucket in range(first, last + 1):
+            when, count, total, minimum, maximum = BUCKET_RECORD.unpack_from(self.map, (bucket % self.slots) * BUCKET_RECORD.size)
+            if count > 0 and when == bucket * self.length:
+                values.append((when, total / count, minimum, maximum, count))
+
+        return values
+
+    def close(self):
+        self.map.close()
+
+class History:
+    """
+    Store of the values of every sensor under `directory`, see above. The
+    listener writes to it with add(), any number of readers can query it at
+    the same time, writes going straight to the shared mappings.
+    """
+
+    def __init__(self, directory, raw_slots = 17280, writable = True):
+        self.directory = directory
+        self.raw_slots = raw_slots
+        self.writable = writable
+        self.sensors = {}
+
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+
+    def sensor_ids(self):
+        return sorted(set(name.rsplit('.', 1)[0] for name in os.listdir(self.directory) if name.endswith('.raw')))
+
+    def rings(self, sensor_id):
+        rings = self.sensors.get(sensor_id)
+        if rings is None:
+            path = os.path.join(self.directory, str(sensor_id))
+            if self.writable:
+                raw_slots = self.raw_slots
+            else:
+                # Readers take the size the writer chose
+                raw_slots = (os.path.getsize(path + '.raw') - RAW_HEADER.size) // RAW_RECORD.size
+
+            rings = [RawRing(path + '.raw', raw_slots, self.writable)]
+            for name, length, slots in TIERS:
+                rings.append(BucketRing(path + '.' + name, length, slots, self.writable))
+
+            self.sensors[sensor_id] = rings
+
+        return rings
+
+    def add(self, sensor_id, value, when = None):
+        if when is None:
+            when = time.time()
+
+        for ring in self.rings(sensor_id):
+            ring.add(when, value)
+
+    def query(self, sensor_id, start, end = None, resolution = None):
+        """
+        Returns (time, mean, min, max, count) tuples for sensor_id between
+        start and end. Without a resolution ('raw', '1m' or '1h'), the finest
+        one that still covers start is used: raw values when the ring goes
+        back that far, then minutes for 30 days, then hours.
+        """
+        if end is None:
+            end = time.time()
+
+        rings = self.rings(sensor_id)
+
+        if resolution is None:
+            age = time.time() - start
+            if rings[0].covers(start):
+                resolution = 'raw'
+            elif age <= TIERS[0][1] * TIERS[0][2]:
+                resolution = TIERS[0][0]
+            else:
+                resolution = TIERS[1][0]
+
+        names = ['raw'] + [name for name, length, slots in TIERS]
+        return rings[names.index(resolution)].range(start, end)
+
+    def close(self):
+        for rings in self.sensors.values():
+            for ring in rings:
+                if self.writable:
+                    ring.map.flush()
+                ring.close()
+
+        self.sensors = {}
@@ -0,0 +1,261 @@
+import time
+
+from decoders import decode
+from filters import WindowAggregator
+from upload_queue import reading
+
+class Listener:
+    """
+    What beacon-listener.py does with a BlueZ signal once it has it, without
+    anything D-Bus specific: find the beacon the device path belongs to,
+    decode its advertisement and queue the resulting readings on `uploads`.
+
+    Signals come from ListenerCore, which keeps the D-Bus plumbing apart and
+    lets the replay harness feed it captured or synthetic signals.
+
+    With several adapters, a beacon heard by more than one of them is only
+    listened to through one: the one it is assigned to, or else the one that
+    hears it with the best RSSI. Another adapter only takes over when it hears
+    it better by `hysteresis` dB, or when the elected one has not heard it for
+    `failover` seconds.
+    """
+
+    def __init__(self, beacons, uploads, adapter_paths = ["/org/bluez/hci0"], verbose = True, hysteresis = 5, failover = 120):
+        self.uploads = uploads
+        self.adapter_paths = list(adapter_paths)
+        self.verbose = verbose
+        self.hysteresis = hysteresis
+        self.failover = failover
+
+        # Called with (path, props) for every signal received, configured
+        # device or not, when set
+        self.recorder = None
+
+        # History the decoded values are written to, before aggregation and
+        # filtering, when set
+        self.history = None
+
+        # Publisher every decoded value goes to as well, whether the metric
+        # has a sensor id or not, when set
+        self.publisher = None
+
+        # Gossip with the other gateways, deciding which one uploads each
+        # beacon, when set
+        self.coordinator = None
+        self.other_gateway = 0
+
+        # Histogram of the time spent decoding each signal, when set
+        self.decode_time = None
+        self.ignored = 0
+        self.other_adapter = 0
+
+        self.beacons = []
+        self.beacons_by_path = {}
+        for beacon in beacons:
+            self.add_beacon(beacon)
+
+    def add_beacon(self, beacon):
+        if beacon.window is not None:
+            beacon.aggregator = WindowAggregator(beacon.window, self.window_closed_callback(beacon))
+
+        self.beacons.append(beacon)
+        for adapter_path in self.adapter_paths:
+            self.beacons_by_path[beacon.device_path(adapter_path)] = (beacon, adapter_path)
+
+    def remove_beacon(self, beacon):
+        # Whatever its open windows hold still goes out
+        if beacon.aggregator is not None:
+            beacon.aggregator.flush(force=True)
+
+        self.beacons.remove(beacon)
+        for adapter_path in self.adapter_paths:
+            self.beacons_by_path.pop(beacon.device_path(adapter_path), None)
+
+    def update_beacons(self, beacons):
+        """
+        Replaces the configured beacons by `beacons`, keeping the ones whose
+        configuration did not change as they are, state included. Returns the
+        lists of added and removed beacons.
+        """
+        current = {beacon.name: beacon for beacon in self.beacons}
+        wanted = {beacon.name: beacon for beacon in beacons}
+
+        removed = [beacon for name, beacon in current.items() if name not in wanted or wanted[name].settings != beacon.settings]
+        added = [beacon for name, beacon in wanted.items() if name not in current or current[name].settings != beacon.settings]
+
+        for beacon in removed:
+            if beacon.name in wanted:
+                self.carry_state(beacon, wanted[beacon.name])
+            self.remove_beacon(beacon)
+
+        for beacon in added:
+            self.add_beacon(beacon)
+
+        return added, removed
+
+    def carry_state(self, old, new):
+        """
+        Hands what was learnt about a beacon over to the Beacon replacing it
+        after its configuration changed, so that the counters the watchdogs
+        compare keep growing and nothing is uploaded twice.
+        """
+        new.signals = old.signals
+        new.duplicates = old.duplicates
+        new.last_battery = old.last_battery
+        new.last_heard = old.last_heard
+        new.mibeacon_counters = old.mibeacon_counters
+        new.elected_adapter = old.elected_adapter
+        new.adapter_signals = old.adapter_signals
+        new.adapter_rssi = old.adapter_rssi
+        new.adapter_seen = old.adapter_seen
+
+        if new.bindkey == old.bindkey:
+            new.cipher = old.cipher
+
+        if new.filter is not None and old.filter is not None:
+            new.filter.last = old.filter.last
+            new.filter.suppressed = old.filter.suppressed
+
+    def signal_received(self, path, props):
+        if self.recorder is not None:
+            self.recorder(path, props)
+
+        entry = self.beacons_by_path.get(path)
+        if entry is None:
+            self.ignored += 1
+            return
+
+        beacon, adapter_path = entry
+        beacon.signals += 1
+        beacon.adapter_signals[adapter_path] = beacon.adapter_signals.get(adapter_path, 0) + 1
+
+        if len(self.adapter_paths) > 1 and not self.elect_adapter(beacon, adapter_path, props):
+            self.other_adapter += 1
+            return
+
+        if self.coordinator is not None:
+            self.coordinator.heard(beacon, props)
+
+        self.handle_properties(beacon, props)
+
+    def elect_adapter(self, beacon, adapter_path, props):
+        """
+        Tells whether a signal received from beacon through adapter_path
+        should be handled, or dropped as a copy of what another adapter hears.
+        """
+        if beacon.adapter is not None:
+            return adapter_path == beacon.adapter
+
+        now = time.monotonic()
+        beacon.adapter_seen[adapter_path] = now
+
+        if 'RSSI' in props:
+            rssi = int(props['RSSI'])
+            previous = beacon.adapter_rssi.get(adapter_path)
+            if previous is None:
+                beacon.adapter_rssi[adapter_path] = rssi
+            else:
+                beacon.adapter_rssi[adapter_path] = 0.8 * previous + 0.2 * rssi
+
+        elected = beacon.elected_adapter
+
+        if elected is None or now - beacon.adapter_seen.get(elected, 0) > self.failover:
+            beacon.elected_adapter = adapter_path
+
+        elif adapter_path != elected and beacon.adapter_rssi.get(adapter_path, -200) > beacon.adapter_rssi.get(elected, -200) + self.hysteresis:
+            if self.verbose:
+                print(beacon.name, "now heard through", adapter_path)
+            beacon.elected_adapter = adapter_path
+
+        return beacon.elected_adapter == adapter_path
+
+    def handle_properties(self, beacon, props):
+        if self.decode_time is None:
+            readings = decode(beacon, props)
+        else:
+            started = time.perf_counter()
+            readings = decode(beacon, props)
+            self.decode_time.observe(time.perf_counter() - started)
+
+        if 'RSSI' in props:
+            readings.append(('signal', int(props['RSSI']), None))
+
+        for metric, value, battery in readings:
+            if self.publisher is not None:
+                self.publisher.publish(beacon.name, metric, value)
+                if battery is not None:
+                    self.publisher.publish(beacon.name, 'battery', battery)
+
+            sensor_id = beacon.sensors.get(metric)
+            if sensor_id is None:
+                continue
+
+            if self.verbose:
+                print(beacon.name, metric, value, battery)
+
+            self.upload(beacon, sensor_id, value, battery)
+
+    def upload(self, beacon, sensor_id, value, battery = None):
+        if self.history is not None:
+            self.history.add(sensor_id, value)
+
+        if beacon.aggregator is not None:
+            beacon.aggregator.add(sensor_id, value, battery)
+        else:
+            self.queue_reading(beacon, sensor_id, value, battery)
+
+    def queue_reading(self, beacon, sensor_id, value, battery = None, stats = None, when = None):
+        if self.coordinator is not None and not self.coordinator.elected(beacon):
+            # Another gateway hears it better and uploads it
+            self.other_gateway += 1
+            return
+
+        if beacon.filter is not None and not beacon.filter.accept(sensor_id, value):
+            return
+
+        self.uploads.put(reading(sensor_id, value, battery, stats, when))
+
+    def window_closed_callback(self, beacon):
+        def window_closed(sensor_id, window):
+            self.queue_reading(beacon, sensor_id, window.mean(), window.battery, window.stats(), window.time)
+
+        return window_closed
+
+    def flush_windows(self, force = False):
+        for beacon in self.beacons:
+            if beacon.aggregator is not None:
+                beacon.aggregator.flush(force=force)
+
+        return True
+
+    def stats(self):
+        return {
+            'beacons': len(self.beacons),
+            'other_adapter': self.other_adapter,
+            'other_gateway': self.other_gateway,
+            'duplicates': sum(beacon.duplicates for beacon in self.beacons),
+            'filtered': sum(beacon.filter.suppressed for beacon in self.beacons if beacon.filter is not None),
+        }
+
+    def metrics(self):
+        metrics = [
+            ('veranda_ble_signals_total', 'counter', "Signals received from each configured beacon",
+                [({'beacon': beacon.name}, beacon.signals) for beacon in self.beacons]),
+            ('veranda_ble_ignored_signals_total', 'counter', "Signals received from devices that are not configured",
+                [({}, self.ignored)]),
+            ('veranda_ble_adapter_signals_total', 'counter', "Signals received from each beacon through each adapter",
+                [({'beacon': beacon.name, 'adapter': adapter_path}, count) for beacon in self.beacons for adapter_path, count in list(beacon.adapter_signals.items())]),
+            ('veranda_ble_other_adapter_signals_total', 'counter', "Signals dropped because another adapter hears the beacon better",
+                [({}, self.other_adapter)]),
+            ('veranda_ble_other_gateway_readings_total', 'counter', "Readings left to another gateway that hears the beacon better",
+                [({}, self.other_gateway)]),
+            ('veranda_ble_duplicate_frames_total', 'counter', "MiBeacon frames dropped as repeats",
+                [({'beacon': beacon.name}, beacon.duplicates) for beacon in self.beacons]),
+            ('veranda_ble_filtered_readings_total', 'counter', "Readings held back by the deadband filter",
+                [({'beacon': beacon.name}, beacon.filter.suppressed) for beacon in self.beacons if beacon.filter is not None]),
+        ]
+
+        if self.decode_time is not None:
+            metrics.append(('veranda_ble_decode_seconds', 'histogram', "Time spent decoding a signal", self.decode_time))
+
+        return metrics
@@ -0,0 +1,107 @@
+import bisect
+import http.server
+import threading
+
+# Upper bounds, in seconds, of the histogram buckets
+DECODE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+UPLOAD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels.items()) + '}'
+
+class Histogram:
+    """
+    Prometheus style histogram with its buckets allocated once, observe() is
+    a bisect and three additions.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels = {}):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(name + '_bucket' + format_labels(dict(labels, le=repr(bound))) + ' ' + str(cumulative))
+
+        lines.append(name + '_bucket' + format_labels(dict(labels, le='+Inf')) + ' ' + str(self.count))
+        lines.append(name + '_sum' + format_labels(labels) + ' ' + repr(self.sum))
+        lines.append(name + '_count' + format_labels(labels) + ' ' + str(self.count))
+        return lines
+
+class Metrics:
+    """
+    Renders the text exposition format from collector functions. Each one
+    returns a list of (name, type, help, samples) tuples, samples being a
+    list of (labels, value) or, for histograms, a Histogram or a list of
+    (labels, Histogram).
+
+    Values are read from the counters where they live when a scrape comes
+    in, nothing is done on the listener's side for metrics that nobody reads.
+    """
+
+    def __init__(self):
+        self.collectors = []
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+
+        for collector in self.collectors:
+            for name, type, help, samples in collector():
+                lines.append('# HELP ' + name + ' ' + help)
+                lines.append('# TYPE ' + name + ' ' + type)
+
+                if type == 'histogram':
+                    if isinstance(samples, Histogram):
+                        samples = [({}, samples)]
+                    for labels, histogram in samples:
+                        lines.extend(histogram.lines(name, labels))
+                else:
+                    for labels, value in samples:
+                        lines.append(name + format_labels(labels) + ' ' + str(value))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address = '127.0.0.1'):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), Handler)
+        server.daemon_threads = True
+
+        thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+        thread.start()
+
+        return server
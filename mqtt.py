@@ -0,0 +1,51 @@
+try:
+    import paho.mqtt.client as paho
+except ImportError:
+    paho = None
+
+class MQTTPublisher:
+    """
+    Publishes every decoded value to a local MQTT broker, as
+    <prefix>/<beacon>/<metric>, QoS 0 and retained so that a consumer that
+    connects gets the last values straight away.
+
+    paho-mqtt does the network side in a thread of its own and reconnects by
+    itself, publish() only queues the message and never waits for the broker.
+    """
+
+    def __init__(self, host, port = 1883, prefix = 'veranda', username = None, password = None):
+        if paho is None:
+            raise RuntimeError("paho-mqtt is needed to publish to MQTT")
+
+        self.prefix = prefix
+        self.published = 0
+        self.topics = {}
+
+        if hasattr(paho, 'CallbackAPIVersion'):
+            # paho-mqtt 2
+            self.client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+        else:
+            self.client = paho.Client()
+
+        if username is not None:
+            self.client.username_pw_set(username, password)
+
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def topic(self, beacon_name, metric):
+        key = (beacon_name, metric)
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.prefix + '/' + beacon_name + '/' + metric
+            self.topics[key] = topic
+
+        return topic
+
+    def publish(self, beacon_name, metric, value):
+        self.client.publish(self.topic(beacon_name, metric), str(value), qos=0, retain=True)
+        self.published += 1
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
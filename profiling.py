@@ -0,0 +1,103 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+class Profiler:
+    """
+    Profiling that can be switched on and off in a running listener.
+
+    toggle_profile() starts a cProfile session, or stops the current one and
+    writes its stats to `directory`, sorted by cumulative time. Only the
+    thread it is called from is profiled, which for the listener is the
+    event loop doing the decoding and filtering.
+
+    snapshot() starts tracemalloc the first time, and afterwards takes a
+    snapshot each time and logs what grew the most since the previous one.
+    log_allocations() logs the `top` lines allocating the most memory, for a
+    periodic report.
+    """
+
+    def __init__(self, directory, top = 20, frames = 5):
+        self.directory = directory
+        self.top = top
+        self.frames = frames
+
+        self.profile = None
+        self.profile_started = None
+        self.previous_snapshot = None
+
+    def path(self, name, extension):
+        return os.path.join(self.directory, 'beacon-listener-%s-%s.%s' % (name, time.strftime('%Y%m%d-%H%M%S'), extension))
+
+    def toggle_profile(self):
+        if self.profile is None:
+            print("Starting profiling")
+            self.profile = cProfile.Profile()
+            self.profile_started = time.monotonic()
+            self.profile.enable()
+            return
+
+        self.profile.disable()
+        elapsed = time.monotonic() - self.profile_started
+
+        path = self.path('profile', 'txt')
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(50)
+        with open(path, 'w') as file:
+            file.write("Profiled for %.1f s\n" % elapsed)
+            file.write(output.getvalue())
+
+        # Also in the binary format, for snakeviz and the like
+        stats.dump_stats(path[:-len('txt')] + 'prof')
+
+        print("Profiled for %.1f s, stats written to %s" % (elapsed, path))
+        self.profile = None
+
+    def start_tracing(self):
+        if not tracemalloc.is_tracing():
+            print("Starting to trace memory allocations")
+            tracemalloc.start(self.frames)
+
+    def take_snapshot(self):
+        # Allocations made by tracemalloc itself are no use
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def snapshot(self):
+        self.start_tracing()
+        snapshot = self.take_snapshot()
+
+        if self.previous_snapshot is None:
+            self.previous_snapshot = snapshot
+            print("First memory snapshot taken, the next one will be compared to it")
+            return
+
+        differences = snapshot.compare_to(self.previous_snapshot, 'traceback')[:self.top]
+        self.previous_snapshot = snapshot
+
+        print("Traced memory: %.1f kB, peak %.1f kB" % tuple(size / 1024 for size in tracemalloc.get_traced_memory()))
+        print("Largest changes since the previous snapshot:")
+        for difference in differences:
+            print("   ", difference)
+
+        # With the whole tracebacks, to tell which closure or proxy it is
+        path = self.path('memory', 'txt')
+        with open(path, 'w') as file:
+            for difference in differences:
+                file.write(str(difference) + '\n')
+                file.write(''.join('    ' + line + '\n' for line in difference.traceback.format()))
+
+        print("Memory snapshot written to", path)
+
+    def log_allocations(self):
+        self.start_tracing()
+
+        print("Top allocators, %.1f kB traced:" % (tracemalloc.get_traced_memory()[0] / 1024))
+        for statistic in self.take_snapshot().statistics('lineno')[:self.top]:
+            print("   ", statistic)
@@ -0,0 +1,238 @@
+"""
+Feeds captured (see ble_capture in .verandarc) or synthetic BlueZ signals to
+the listener, with uploads going to a local mock of the API, and reports how
+fast it went.
+
+Signals go through the same path as in beacon-listener.py: a thread standing
+in for the GLib one calls ListenerCore.properties_changed(), and the readings
+are uploaded by an AsyncUploadQueue.
+
+    python replay.py capture.jsonl.gz [--speed N] [--config ~/.verandarc]
+    python replay.py --synthetic 2000 [--signals 100000]
+
+--speed 1 replays at the pace of the capture, --speed 0 as fast as possible.
+Without --config, every device of the capture gets temperature, humidity and
+signal sensor ids of its own.
+"""
+
+import argparse
+import asyncio
+import configparser
+import gzip
+import http.server
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from beacons import Beacon, load_beacons
+from capture import read_capture
+from core import ListenerCore
+from listener import Listener
+from upload_queue import AsyncUploadQueue
+from veranda_api import APIClient
+
+class MockAPIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.count(1, 1)
+        self.answer(b"ok")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        self.server.count(1, len(json.loads(body)))
+        self.answer(b"ok")
+
+    def answer(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockAPIServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MockAPIHandler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.readings = 0
+
+    def count(self, requests, readings):
+        with self.lock:
+            self.requests += requests
+            self.readings += readings
+
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_port) + '/data'
+
+def split_path(path):
+    adapter_path, device = path.rsplit('/dev_', 1)
+    return adapter_path, device.replace('_', ':')
+
+def synthetic_beacons(count):
+    beacons = []
+    for i in range(count):
+        address = ':'.join('%02X' % byte for byte in (0xEC, 0xFE, 0x7E, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff))
+        beacon = Beacon('synthetic' + str(i), address)
+        beacon.sensors = {'temperature': str(3 * i), 'signal': str(3 * i + 2)}
+        beacons.append(beacon)
+
+    return beacons
+
+def synthetic_signals(beacons, adapter_path, count):
+    """
+    SensorBug advertisements from every beacon in turn, with a slowly moving
+    temperature and a noisy RSSI.
+    """
+    paths = [beacon.device_path(adapter_path) for beacon in beacons]
+
+    for i in range(count):
+        path = paths[i % len(paths)]
+        temperature = int((20 + (i // len(paths)) % 50 / 10.0) / 0.0625)
+        data = bytes([0x02, 0x00, 0x3c, 85, 0x00, 0x00, 0x43, 0x01]) + temperature.to_bytes(2, 'little')
+        props = {
+            'RSSI': random.randint(-95, -40),
+            'ManufacturerData': {0x0085: data},
+        }
+
+        yield i * 0.001, path, props
+
+class Feeder:
+    """
+    Stands in for the GLib main loop of beacon-listener.py: ListenerCore.run()
+    calls run() from a thread of its own, which hands every signal to the
+    core as dbus-python would, then stops the core.
+    """
+
+    def __init__(self, core, signals, speed = 0):
+        self.core = core
+        self.signals = signals
+        self.speed = speed
+        self.stopped = False
+
+        self.latencies = []
+        self.elapsed = 0
+
+    def run(self):
+        started = time.perf_counter()
+        first_signal = None
+
+        for signal_time, path, props in self.signals:
+            if self.stopped:
+                break
+
+            if self.speed > 0:
+                if first_signal is None:
+                    first_signal = signal_time
+                delay = (signal_time - first_signal) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            before = time.perf_counter()
+            self.core.properties_changed('org.bluez.Device1', props, [], path=path)
+            self.latencies.append(time.perf_counter() - before)
+
+        self.elapsed = time.perf_counter() - started
+
+        # The core then decodes what is still in the intake and drains the
+        # upload queue, as it does on SIGTERM
+        self.core.loop.call_soon_threadsafe(self.core.stop)
+
+    def quit(self):
+        self.stopped = True
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays BLE signals through the beacon listener")
+    parser.add_argument('capture', nargs='?', help="capture file written by the listener (ble_capture)")
+    parser.add_argument('--speed', type=float, default=0, help="replay speed, 1 for real time, 0 for as fast as possible")
+    parser.add_argument('--config', help=".verandarc to take beacons and upload settings from")
+    parser.add_argument('--synthetic', type=int, default=0, help="number of virtual beacons to generate signals for")
+    parser.add_argument('--signals', type=int, default=100000, help="number of synthetic signals")
+    parser.add_argument('--adapter', default='/org/bluez/hci0')
+    arguments = parser.parse_args()
+
+    if arguments.capture is None and arguments.synthetic == 0:
+        parser.error("either a capture file or --synthetic is needed")
+
+    settings = {}
+    if arguments.config is not None:
+        config = configparser.ConfigParser()
+        with open(os.path.expanduser(arguments.config)) as lines:
+            config.read_file(itertools.chain(("[root]",), lines))
+        settings = config['root']
+
+    if arguments.synthetic > 0:
+        adapter_paths = [arguments.adapter]
+        beacons = synthetic_beacons(arguments.synthetic)
+        signals = synthetic_signals(beacons, arguments.adapter, arguments.signals)
+    else:
+        signals = list(read_capture(arguments.capture))
+        devices = set(split_path(path) for t, path, props in signals)
+        adapter_paths = sorted(set(adapter_path for adapter_path, address in devices))
+
+        if 'ble' in settings:
+            beacons = load_beacons(settings)
+        else:
+            beacons = []
+            for i, address in enumerate(sorted(set(address for adapter_path, address in devices))):
+                beacon = Beacon('captured' + str(i), address)
+                beacon.sensors = {'temperature': str(3 * i), 'humidity': str(3 * i + 1), 'signal': str(3 * i + 2)}
+                beacons.append(beacon)
+
+    server = MockAPIServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    workers = int(settings.get('ble_upload_workers', 2))
+    api = APIClient('replay', server.url(), pool_size=workers)
+    uploads = AsyncUploadQueue(
+        api.upload,
+        depth=int(settings.get('ble_queue_depth', 1000)),
+        workers=workers,
+        batch_size=int(settings.get('ble_batch_size', 1)),
+        batch_interval=float(settings.get('ble_batch_interval', 1)),
+    )
+
+    listener = Listener(beacons, uploads, adapter_paths, verbose=False)
+    core = ListenerCore(listener, uploads)
+    feeder = Feeder(core, signals, arguments.speed)
+
+    started = time.perf_counter()
+    asyncio.run(core.run(feeder))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(feeder.latencies)
+    print("Beacons:", len(beacons))
+    print("Signals: %d fed in %.2f s, %.0f signals/s" % (len(latencies), feeder.elapsed, len(latencies) / feeder.elapsed if feeder.elapsed else 0))
+    print("Processed and uploaded in %.2f s, %.0f signals/s" % (elapsed, len(latencies) / elapsed if elapsed else 0))
+    print("D-Bus callback latency: p50 %.1f us, p90 %.1f us, p99 %.1f us, max %.1f us" % (
+        percentile(latencies, 0.5) * 1e6,
+        percentile(latencies, 0.9) * 1e6,
+        percentile(latencies, 0.99) * 1e6,
+        latencies[-1] * 1e6 if latencies else 0,
+    ))
+    print("Intake: %d signals dropped, %d from devices that are not configured" % (core.dropped_signals, listener.ignored))
+    print("Upload queue:", uploads.stats())
+    print("Listener:", listener.stats())
+    print("Mock API: %d requests, %d readings" % (server.requests, server.readings))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    sys.exit(main())
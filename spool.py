@@ -0,0 +1,149 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+from upload_queue import Reading, unsent
+
+class Spool:
+    """
+    On-disk store for readings that could not be uploaded, so that they
+    survive an uplink outage (and a restart of the listener).
+
+    Readings are kept in an SQLite database in WAL mode. They are handed back
+    oldest first by replay() and only deleted once the server has accepted
+    them. When the spool holds more than `max_readings`, the oldest ones are
+    deleted to make room.
+
+    Readings that have to be replayed some other way are kept apart, in a
+    Spool of their own with another `table` in the same database.
+    """
+
+    def __init__(self, path, max_readings = 100000, table = 'readings'):
+        self.path = path
+        self.max_readings = max_readings
+        self.table = table
+        self.lock = threading.Lock()
+
+        self.discarded = 0
+        self.replayed = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS %s (
+                id INTEGER PRIMARY KEY,
+                time REAL NOT NULL,
+                sensor_id TEXT NOT NULL,
+                value REAL NOT NULL,
+                battery REAL,
+                stats TEXT
+            )
+        """ % table)
+        self.db.execute("CREATE INDEX IF NOT EXISTS %s_time ON %s (time)" % (table, table))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+
+    def add(self, readings):
+        rows = []
+        for reading in readings:
+            stats = None
+            if reading.stats is not None:
+                stats = json.dumps(reading.stats)
+
+            rows.append((reading.time or time.time(), str(reading.sensor_id), reading.value, reading.battery, stats))
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT INTO %s (time, sensor_id, value, battery, stats) VALUES (?, ?, ?, ?, ?)" % self.table, rows)
+
+            count = self.db.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+            if count > self.max_readings:
+                excess = count - self.max_readings
+                self.db.execute("DELETE FROM %s WHERE id IN (SELECT id FROM %s ORDER BY time LIMIT ?)" % (self.table, self.table), (excess,))
+                self.discarded += excess
+
+            self.db.execute("COMMIT")
+
+    def oldest(self, limit):
+        with self.lock:
+            rows = self.db.execute("SELECT id, sensor_id, value, battery, time, stats FROM %s ORDER BY time LIMIT ?" % self.table, (limit,)).fetchall()
+
+        ids = []
+        readings = []
+        for id, sensor_id, value, battery, when, stats in rows:
+            if stats is not None:
+                stats = json.loads(stats)
+
+            ids.append(id)
+            readings.append(Reading(sensor_id, value, battery, when, stats))
+
+        return ids, readings
+
+    def acknowledge(self, ids):
+        with self.lock:
+            self.db.executemany("DELETE FROM %s WHERE id = ?" % self.table, [(id,) for id in ids])
+
+    def replay_batch(self, send, batch_size = 50):
+        """
+        Sends the oldest batch_size spooled readings with send(readings) and
+        deletes them once that went through. Returns how many were sent, 0
+        when the spool is empty. Exceptions from send() are passed along,
+        once the readings it did send are deleted.
+        """
+        ids, readings = self.oldest(batch_size)
+        if not readings:
+            return 0
+
+        try:
+            send(readings)
+        except Exception as e:
+            # Those that did go through are not kept for another round
+            left = set(map(id, unsent(e, readings)))
+            sent = [row_id for row_id, reading in zip(ids, readings) if id(reading) not in left]
+            self.acknowledge(sent)
+            self.replayed += len(sent)
+            raise
+
+        self.acknowledge(ids)
+        self.replayed += len(readings)
+        return len(readings)
+
+    async def replay_forever(self, send, batch_size = 50, rate = 10, idle = 30):
+        """
+        Every `idle` seconds, replays the spool until it is empty or until an
+        upload fails, at most `rate` readings per second. The database and
+        the uploads are used from the default executor.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(idle)
+
+            sent = 0
+            while True:
+                try:
+                    count = await loop.run_in_executor(None, self.replay_batch, send, batch_size)
+                except Exception as e:
+                    print("Spool replay failed", e)
+                    break
+
+                if count == 0:
+                    break
+
+                sent += count
+                await asyncio.sleep(count / rate)
+
+            if sent > 0:
+                print("Replayed", sent, "spooled readings")
+
+    def stats(self):
+        return {
+            'spooled': len(self),
+            'replayed': self.replayed,
+            'discarded': self.discarded,
+        }
@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+from filters import Window
+
+# What the listener knows about each beacon that it cannot get back quickly
+# after a restart: the last battery level (APlant devices only give it in
+# Eddystone frames, every few minutes), the MiBeacon frame counters, the
+# values last let through by the deadband filter, the aggregation windows
+# still open and when the beacon was last heard, to backfill what was missed
+# while the listener was stopped.
+#
+# Monotonic times are saved as ages, so that they mean the same once restored
+# in another process.
+
+def beacon_state(beacon, now):
+    state = {
+        'last_battery': beacon.last_battery,
+        'mibeacon_counters': beacon.mibeacon_counters,
+        'last_heard': beacon.last_heard,
+    }
+
+    if beacon.filter is not None:
+        state['filter'] = {sensor_id: (value, now - last_time) for sensor_id, (value, last_time) in beacon.filter.last.items()}
+
+    if beacon.aggregator is not None:
+        state['windows'] = {
+            sensor_id: {
+                'age': now - window.start,
+                'count': window.count,
+                'minimum': window.minimum,
+                'maximum': window.maximum,
+                'total': window.total,
+                'last': window.last,
+                'battery': window.battery,
+                'time': window.time,
+            }
+            for sensor_id, window in beacon.aggregator.windows.items() if window.count > 0
+        }
+
+    return state
+
+def save_state(path, beacons):
+    now = time.monotonic()
+    state = {
+        'saved': time.time(),
+        'beacons': {beacon.name: beacon_state(beacon, now) for beacon in beacons},
+    }
+
+    # Written aside and renamed, the listener can be killed at any time
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(state, file)
+    os.replace(temporary, path)
+
+    return True
+
+def restore_state(path, beacons):
+    """
+    Restores what save_state() saved for the beacons that are still
+    configured. Returns the number of beacons restored.
+    """
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return 0
+    except ValueError as e:
+        print("Could not read state from", path, e)
+        return 0
+
+    now = time.monotonic()
+    # Time spent stopped counts too
+    downtime = max(0, time.time() - state.get('saved', time.time()))
+    restored = 0
+
+    for beacon in beacons:
+        saved = state.get('beacons', {}).get(beacon.name)
+        if saved is None:
+            continue
+
+        beacon.last_battery = saved.get('last_battery', 0)
+        beacon.mibeacon_counters = {int(data_type): counter for data_type, counter in saved.get('mibeacon_counters', {}).items()}
+        beacon.last_heard = saved.get('last_heard')
+
+        if beacon.filter is not None:
+            for sensor_id, (value, age) in saved.get('filter', {}).items():
+                beacon.filter.last[sensor_id] = (value, now - age - downtime)
+
+        if beacon.aggregator is not None:
+            for sensor_id, saved_window in saved.get('windows', {}).items():
+                age = saved_window['age'] + downtime
+                if age >= beacon.aggregator.length:
+                    # Past its end, flush_windows() most likely closed and
+                    # uploaded it between the snapshot and the stop
+                    continue
+
+                window = Window()
+                window.reset(now - age)
+                window.count = saved_window['count']
+                window.minimum = saved_window['minimum']
+                window.maximum = saved_window['maximum']
+                window.total = saved_window['total']
+                window.last = saved_window['last']
+                window.battery = saved_window['battery']
+                window.time = saved_window['time']
+                beacon.aggregator.windows[sensor_id] = window
+
+        restored += 1
+
+    return restored
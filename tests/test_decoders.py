@@ -0,0 +1,51 @@
+import struct
+import unittest
+
+from beacons import Beacon
+from decoders import AESCCM, decode, uuid16
+
+MIBEACON = uuid16(0xfe95)
+
+# Encrypted MiBeacon v5 frame from an LYWSD03MMC, and its bindkey
+LYWSD03MMC_ADDRESS = 'A4:C1:38:02:83:F4'
+LYWSD03MMC_BINDKEY = 'e9ea895fac7cca6d30532432a516f3a8'
+LYWSD03MMC_FRAME = bytes.fromhex('58585b0550f4830238c1a495ef58763c26000097e2abb5')
+
+def beacon(address = LYWSD03MMC_ADDRESS, bindkey = LYWSD03MMC_BINDKEY):
+    beacon = Beacon('lywsd03mmc', address)
+    beacon.bindkey = bytes.fromhex(bindkey)
+    return beacon
+
+class EncryptedMiBeaconTest(unittest.TestCase):
+    @unittest.skipIf(AESCCM is None, "cryptography is not installed")
+    def test_known_frame(self):
+        self.assertEqual(decode(beacon(), {'ServiceData': {MIBEACON: LYWSD03MMC_FRAME}}), [('humidity', 46.7, None)])
+
+    @unittest.skipIf(AESCCM is None, "cryptography is not installed")
+    def test_wrong_bindkey(self):
+        self.assertEqual(decode(beacon(bindkey='00' * 16), {'ServiceData': {MIBEACON: LYWSD03MMC_FRAME}}), [])
+
+    @unittest.skipIf(AESCCM is None, "cryptography is not installed")
+    def test_capabilities(self):
+        # Frame with the MAC address, a capability byte and an IO capability
+        # byte before the objects: temperature as a float, then battery
+        key = bytes.fromhex(LYWSD03MMC_BINDKEY)
+        address = bytes.fromhex(LYWSD03MMC_ADDRESS.replace(':', ''))[::-1]
+        header = struct.pack('<HHB', 0x5878, 0x055b, 0x12) + address + bytes([0x28, 0x00])
+        extension = bytes([0x01, 0x00, 0x00])
+        objects = struct.pack('<HBf', 0x4c01, 4, 21.5) + struct.pack('<HBB', 0x4803, 1, 87)
+
+        encrypted = AESCCM(key, tag_length=4).encrypt(address + header[2:5] + extension, objects, b"\x11")
+        frame = header + encrypted[:-4] + extension + encrypted[-4:]
+
+        decoded = beacon()
+        self.assertEqual(decode(decoded, {'ServiceData': {MIBEACON: frame}}), [('temperature', 21.5, None)])
+        self.assertEqual(decoded.last_battery, 87)
+
+    def test_short_frames(self):
+        # Capability flag set, but the frame stops before the capability byte
+        for frame in (bytes.fromhex('78585b0512') + bytes(6), bytes.fromhex('78585b0513') + bytes(8)):
+            self.assertEqual(decode(beacon(), {'ServiceData': {MIBEACON: frame}}), [])
+
+if __name__ == '__main__':
+    unittest.main()
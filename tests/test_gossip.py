@@ -0,0 +1,104 @@
+import time
+import unittest
+
+from beacons import Beacon
+from gossip import Gossip
+
+BEACON = Beacon('lywsd03mmc', 'A4:C1:38:02:83:F4')
+
+class Network:
+    """
+    Stands in for the UDP sockets of every gateway, each message sent being
+    delivered to all the others.
+    """
+
+    def __init__(self, *names):
+        self.gateways = [Gossip(name, [], 0) for name in names]
+        self.inboxes = {}
+
+        for gossip in self.gateways:
+            gossip.socket = Socket(self, gossip.name)
+            gossip.peers = [other.name for other in self.gateways if other is not gossip]
+            self.inboxes[gossip.name] = []
+
+    def hear(self, gossip, rssi):
+        gossip.own[BEACON.name] = (rssi, time.monotonic())
+
+    def send(self, *gateways):
+        for gossip in gateways or self.gateways:
+            gossip.send()
+
+        for gossip in self.gateways:
+            while self.inboxes[gossip.name]:
+                gossip.read()
+
+class Socket:
+    def __init__(self, network, name):
+        self.network = network
+        self.name = name
+
+    def sendto(self, message, peer):
+        self.network.inboxes[peer].append(message)
+
+    def recvfrom(self, size):
+        return self.network.inboxes[self.name].pop(0), (self.name, 0)
+
+class ElectionTest(unittest.TestCase):
+    def test_converges_after_split_first_elections(self):
+        network = Network('a', 'b')
+        a, b = network.gateways
+
+        # a holds its first election while b hears the beacon better...
+        network.hear(a, -70)
+        network.hear(b, -68)
+        network.send()
+        self.assertFalse(a.elected(BEACON))
+
+        # ...and b holds its own once it has got worse, electing a
+        network.hear(b, -71)
+        network.send(b)
+        self.assertFalse(b.elected(BEACON))
+
+        # Both have the same values now, one of them has to upload
+        self.assertEqual([a.elected(BEACON), b.elected(BEACON)], [True, False])
+
+        for i in range(3):
+            network.send()
+            self.assertEqual([a.elected(BEACON), b.elected(BEACON)], [True, False])
+
+    def test_hysteresis(self):
+        network = Network('a', 'b')
+        a, b = network.gateways
+
+        network.hear(a, -70)
+        network.hear(b, -80)
+        network.send()
+        network.send()
+        self.assertEqual([a.elected(BEACON), b.elected(BEACON)], [True, False])
+
+        # Not enough better to take over from a, which says it uploads
+        network.hear(b, -67)
+        network.send()
+        self.assertEqual([a.elected(BEACON), b.elected(BEACON)], [True, False])
+
+        network.hear(b, -60)
+        network.send()
+        self.assertEqual([a.elected(BEACON), b.elected(BEACON)], [False, True])
+
+        network.send()
+        self.assertEqual([a.elected(BEACON), b.elected(BEACON)], [False, True])
+
+    def test_alone(self):
+        network = Network('a', 'b')
+        a, b = network.gateways
+
+        # Until a has told b it hears the beacon, b does not know to leave it
+        network.hear(a, -90)
+        self.assertTrue(a.elected(BEACON))
+
+        network.send()
+        self.assertTrue(a.elected(BEACON))
+        self.assertEqual(a.metrics()[2][3], [({}, 1)])
+
+if __name__ == '__main__':
+    unittest.main()
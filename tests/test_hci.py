@@ -0,0 +1,54 @@
+import unittest
+
+from beacons import Beacon
+from decoders import decode, uuid16
+from hci import parse_event
+
+# LE Advertising Report event from an LYWSD03MMC, as read from an HCI socket
+LYWSD03MMC_EVENT = bytes.fromhex(
+    '043e2a02010000f4830238c1a41e0201061a1695fe58585b0550f4830238c1a495ef58763c26000097e2abb5e2'
+)
+
+# The same report followed by one from a SensorBug whose RSSI the controller
+# did not have (127), and one whose second AD structure is cut short
+SENSORBUG_REPORT = bytes.fromhex('0301489a107efeec' '11' '020106' '0dff8500' '02003c8500004301' '5001' '7f')
+TRUNCATED_REPORT = bytes.fromhex('0000112233445566' '0b' '05ff4c00aabb' '0916aafe20' 'c4')
+
+def event(*reports):
+    parameters = bytes([0x02, len(reports)]) + b''.join(reports)
+    return bytes([0x04, 0x3e, len(parameters)]) + parameters
+
+class ParseEventTest(unittest.TestCase):
+    def test_single_report(self):
+        reports = list(parse_event(LYWSD03MMC_EVENT))
+
+        self.assertEqual(reports, [('A4:C1:38:02:83:F4', {
+            'ServiceData': {uuid16(0xfe95): bytes.fromhex('58585b0550f4830238c1a495ef58763c26000097e2abb5')},
+            'RSSI': -30,
+        })])
+
+    def test_several_reports(self):
+        reports = list(parse_event(event(LYWSD03MMC_EVENT[5:], SENSORBUG_REPORT, TRUNCATED_REPORT)))
+
+        self.assertEqual([address for address, props in reports], ['A4:C1:38:02:83:F4', 'EC:FE:7E:10:9A:48', '66:55:44:33:22:11'])
+
+        address, props = reports[1]
+        self.assertNotIn('RSSI', props)
+        self.assertEqual(props['ManufacturerData'], {0x0085: bytes.fromhex('02003c85000043015001')})
+        self.assertEqual(decode(Beacon('sensorbug', address), props), [('temperature', 21.0, 0x85)])
+
+        address, props = reports[2]
+        self.assertEqual(props, {'ManufacturerData': {0x004c: b'\xaa\xbb'}, 'RSSI': -60})
+
+    def test_truncated_event(self):
+        # The last report lost its RSSI byte, the ones before it still count
+        reports = list(parse_event(event(LYWSD03MMC_EVENT[5:], SENSORBUG_REPORT[:-1])))
+
+        self.assertEqual([address for address, props in reports], ['A4:C1:38:02:83:F4'])
+
+    def test_other_events(self):
+        # Command Complete for LE Set Scan Enable
+        self.assertEqual(list(parse_event(bytes.fromhex('040e0401 0c2000'.replace(' ', '')))), [])
+
+if __name__ == '__main__':
+    unittest.main()
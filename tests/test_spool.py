@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+from spool import Spool
+from upload_queue import reading
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'spool.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_tables_kept_apart(self):
+        spool = Spool(self.path)
+        backfill = Spool(self.path, table='backfill')
+
+        spool.add([reading(11, 21.5, when=1000)])
+        backfill.add([reading(11, 20.0, stats={'min': 19.5, 'max': 20.5}, when=100), reading(12, 45.0, when=100)])
+
+        sent = []
+        self.assertEqual(backfill.replay_batch(sent.append), 2)
+        self.assertEqual([(one.sensor_id, one.value, one.stats) for one in sent[0]], [('11', 20.0, {'min': 19.5, 'max': 20.5}), ('12', 45.0, None)])
+
+        self.assertEqual(len(backfill), 0)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(len(Spool(self.path, table='backfill')), 0)
+
+    def test_failed_replay_kept(self):
+        backfill = Spool(self.path, table='backfill')
+        backfill.add([reading(11, 20.0, when=100)])
+
+        def send(readings):
+            raise RuntimeError("the API does not take batches")
+
+        with self.assertRaises(RuntimeError):
+            backfill.replay_batch(send)
+
+        self.assertEqual(len(backfill), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import unittest
+
+from upload_queue import AsyncUploadQueue, reading
+
+class AsyncUploadQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_failing_spool(self):
+        def send(readings):
+            raise OSError("network is unreachable")
+
+        def failed(readings):
+            raise OSError("database or disk is full")
+
+        uploads = AsyncUploadQueue(send, workers=2, failed=failed)
+        uploads.start()
+
+        for value in range(4):
+            uploads.put(reading(11, value))
+        await asyncio.sleep(0.2)
+
+        # The workers are still there for the next readings
+        self.assertEqual(uploads.stats()['failed'], 4)
+        self.assertFalse(any(task.done() for task in uploads.tasks))
+
+        await uploads.drain(0)
+
+    async def test_drain_in_flight(self):
+        release = threading.Event()
+
+        def send(readings):
+            release.wait()
+
+        uploads = AsyncUploadQueue(send, batch_size=2)
+        uploads.start()
+
+        readings = [reading(11, value) for value in range(5)]
+        for one in readings:
+            uploads.put(one)
+        await asyncio.sleep(0.1)
+
+        # The batch being sent when time runs out is handed back too
+        left = await uploads.drain(0.2)
+        release.set()
+
+        self.assertEqual(sorted(left, key=lambda one: one.value), readings)
+
+if __name__ == '__main__':
+    unittest.main()
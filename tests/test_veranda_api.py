@@ -0,0 +1,110 @@
+import gzip
+import http.server
+import json
+import threading
+import unittest
+
+from upload_queue import reading
+from veranda_api import APIClient, UploadError
+
+class MockAPIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        sensor_id = self.path.split('?')[0].rsplit('/', 1)[1]
+        self.server.gets.append(sensor_id)
+        self.answer(self.server.statuses.get(sensor_id, 200))
+
+    def do_POST(self):
+        body = gzip.decompress(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.posts.append([entry['sensor'] for entry in json.loads(body)])
+        self.answer(self.server.batch_status)
+
+    def answer(self, status):
+        body = b"ok" if status == 200 else b"error"
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockAPIHandler)
+        self.server.daemon_threads = True
+        self.server.batch_status = 200
+        self.server.statuses = {}
+        self.server.gets = []
+        self.server.posts = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.api = APIClient('test', 'http://127.0.0.1:%d/data' % self.server.server_port, retries=0)
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batch(self):
+        self.api.upload([reading(11, 21.5), reading(12, -70)])
+
+        self.assertEqual(self.server.posts, [['11', '12']])
+        self.assertEqual(self.server.gets, [])
+
+    def test_unknown_sensor_in_batch(self):
+        # The batch is refused because of sensor 999, only that one goes
+        self.server.batch_status = 404
+        self.server.statuses = {'999': 404}
+
+        results = self.api.upload([reading(11, 21.5), reading(999, 3), reading(12, -70)])
+
+        self.assertEqual(results, [b"ok", b"ok"])
+        self.assertEqual(self.server.gets, ['11', '999', '12'])
+        self.assertEqual(self.api.rejected, 1)
+        self.assertTrue(self.api.batches_supported)
+
+        # Batches are still sent afterwards
+        self.server.batch_status = 200
+        self.api.upload([reading(11, 21.5), reading(12, -70)])
+        self.assertEqual(self.server.posts[-1], ['11', '12'])
+
+    def test_bad_request_batch(self):
+        self.server.batch_status = 400
+        self.server.statuses = {'999': 400}
+
+        self.api.upload([reading(11, 21.5), reading(999, 3)])
+
+        self.assertEqual(self.api.rejected, 1)
+        self.assertTrue(self.api.batches_supported)
+
+    def test_batches_not_supported(self):
+        self.server.batch_status = 405
+
+        self.api.upload([reading(11, 21.5), reading(12, -70)])
+
+        self.assertFalse(self.api.batches_supported)
+        self.assertEqual(self.server.gets, ['11', '12'])
+
+    def test_batch_endpoint_missing(self):
+        # Every reading goes through on its own: it was the batch
+        self.server.batch_status = 404
+
+        self.api.upload([reading(11, 21.5), reading(12, -70)])
+
+        self.assertFalse(self.api.batches_supported)
+        self.assertEqual(self.api.rejected, 0)
+
+    def test_failure_partway(self):
+        self.server.batch_status = 405
+        self.server.statuses = {'12': 503}
+        readings = [reading(11, 21.5), reading(12, -70), reading(13, 50)]
+
+        with self.assertRaises(UploadError) as context:
+            self.api.upload(readings)
+
+        self.assertEqual(context.exception.readings, readings[1:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import asyncio
+import collections
+import time
+
+# time is the wall clock time the reading was received at, stats holds
+# count/min/max/mean/last when the reading is an aggregate of several values
+Reading = collections.namedtuple('Reading', ['sensor_id', 'value', 'battery', 'time', 'stats'], defaults=[None, None, None])
+
+def reading(sensor_id, value, battery = None, stats = None, when = None):
+    if when is None:
+        when = time.time()
+
+    return Reading(sensor_id, value, battery, when, stats)
+
+def unsent(error, readings):
+    # send() can tell which readings did not go through by raising an
+    # exception with a `readings` attribute (veranda_api.UploadError)
+    return getattr(error, 'readings', readings)
+
+class AsyncUploadQueue:
+    """
+    Bounded in-memory queue between the asyncio core and the HTTP uploads.
+
+    put() is called from the event loop and only appends to a deque, so
+    decoding never waits on the network. When the queue is full the oldest
+    reading is dropped and counted, on the basis that a fresher value is worth
+    more than a stale one.
+
+    send() is called with a list of readings by worker tasks, in the default
+    executor since the API client is blocking. With batch_size above 1, a
+    worker waits until batch_size readings are queued or batch_interval
+    seconds have passed, whichever comes first, and hands them all over at
+    once.
+
+    Readings that send() failed to upload are passed to failed(), if given,
+    in the default executor as well.
+    """
+
+    def __init__(self, send, depth = 1000, workers = 1, batch_size = 1, batch_interval = 0, failed = None):
+        self.send = send
+        self.on_failure = failed
+        self.depth = depth
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.readings = collections.deque()
+
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+        self.changed = None
+        self.tasks = []
+        self.flushing = False
+
+        # send() future => readings it is uploading
+        self.sending = {}
+
+    def start(self):
+        self.changed = asyncio.Event()
+        for i in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.work(), name="upload-" + str(i)))
+
+    def put(self, reading):
+        if len(self.readings) >= self.depth:
+            self.readings.popleft()
+            self.dropped += 1
+
+        self.readings.append(reading)
+        self.queued += 1
+        self.changed.set()
+
+    def __len__(self):
+        return len(self.readings)
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'depth': len(self.readings),
+            'dropped': self.dropped,
+            'sent': self.sent,
+            'failed': self.failed,
+        }
+
+    async def wait_change(self, timeout = None):
+        self.changed.clear()
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def take(self):
+        while not self.readings:
+            await self.wait_change()
+
+        if self.batch_size > 1:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.batch_interval
+            while len(self.readings) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self.flushing:
+                    break
+                await self.wait_change(remaining)
+
+        count = min(len(self.readings), self.batch_size)
+        return [self.readings.popleft() for i in range(count)]
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            readings = await self.take()
+            if not readings:
+                continue
+
+            sending = loop.run_in_executor(None, self.send, readings)
+            self.sending[sending] = readings
+            try:
+                await sending
+            except Exception as e:
+                print("HTTP error", e)
+                failed = unsent(e, readings)
+                self.failed += len(failed)
+            else:
+                failed = []
+                self.sent += len(readings)
+
+            del self.sending[sending]
+
+            if failed and self.on_failure is not None:
+                # The worker has to outlive a spool that cannot take them
+                try:
+                    await loop.run_in_executor(None, self.on_failure, failed)
+                except Exception as e:
+                    print("Could not keep", len(failed), "readings that failed to upload", e)
+
+    async def drain(self, timeout):
+        """
+        Waits up to `timeout` seconds for the queue to be uploaded, then stops
+        the workers and returns the readings that did not make it, those that
+        were still being sent included.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        # Don't wait for batches to fill up, there won't be any more readings
+        self.flushing = True
+        self.changed.set()
+
+        while (self.readings or self.sending) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        # A send() cut short may still go through in its thread, its readings
+        # would then be uploaded twice rather than lost
+        left = []
+        for sending, readings in self.sending.items():
+            if not sending.done():
+                left.extend(readings)
+            elif not sending.cancelled() and sending.exception() is not None:
+                left.extend(unsent(sending.exception(), readings))
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        left.extend(self.readings)
+        self.readings.clear()
+        return left
@@ -0,0 +1,244 @@
+import gzip
+import http.client
+import json
+import queue
+import time
+
+from urllib.parse import urlencode, urlsplit
+
+VERSION = 1
+API_BASE_URL = "https://veranda.seos.fr/data"
+
+class APIError(Exception):
+    def __init__(self, status, body):
+        super().__init__("HTTP " + str(status) + ": " + repr(body[:200]))
+        self.status = status
+        self.body = body
+
+class UploadError(Exception):
+    """
+    Raised by APIClient.upload() when it stopped partway, `readings` being
+    the ones that were not sent, so that those already accepted are not
+    spooled and uploaded a second time.
+    """
+
+    def __init__(self, error, readings):
+        super().__init__(str(error))
+        self.error = error
+        self.readings = readings
+
+def rejected(error):
+    """
+    Tells whether the server refused a reading for good (an unknown sensor
+    id, say), in which case sending it again would not change anything.
+    Authentication errors and rate limiting are about the client, not the
+    reading, and are worth retrying.
+    """
+    return isinstance(error, APIError) and 400 <= error.status < 500 and error.status not in (401, 403, 408, 429)
+
+# Answers meaning the server does not know about batch uploads at all. A
+# 400 or 404 could just as well be about one of the readings in the batch.
+BATCH_REJECTED_STATUSES = (405, 415, 501)
+
+class APIClient:
+    """
+    Client for the veranda.seos.fr API keeping its connections open.
+
+    Connections are kept in a small pool and reused between requests, so the
+    TCP and TLS handshakes are only paid when the server (or the network) drops
+    one. A request that fails on a dead connection is retried on a fresh one,
+    with an exponential backoff between attempts.
+    """
+
+    def __init__(self, api_key, base_url = API_BASE_URL, pool_size = 2, retries = 3, backoff = 0.5, timeout = 10):
+        url = urlsplit(base_url)
+
+        self.api_key = api_key
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.headers = {
+            "X-Api-Key": api_key,
+            "X-Veranda-Client-Version": str(VERSION),
+        }
+
+        self.batches_supported = True
+        self.rejected = 0
+
+        # Number of answers per HTTP status, 'error' for requests that got no
+        # answer at all, and an optional histogram of request durations
+        self.responses = {}
+        self.latency = None
+
+        self.pool = queue.LifoQueue()
+        for i in range(pool_size):
+            self.pool.put(None)
+
+    def connect(self):
+        if self.scheme == 'http':
+            return http.client.HTTPConnection(self.host, timeout=self.timeout)
+        else:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+
+    def request(self, method, path, body = None, headers = {}):
+        all_headers = dict(self.headers)
+        all_headers.update(headers)
+
+        # Blocks until one of the pooled connections is free
+        connection = self.pool.get()
+
+        try:
+            for attempt in range(self.retries + 1):
+                if connection is None:
+                    connection = self.connect()
+
+                started = time.monotonic()
+                try:
+                    connection.request(method, self.prefix + path, body=body, headers=all_headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    connection.close()
+                    connection = None
+                    self.count_response('error', started)
+
+                    if attempt == self.retries:
+                        raise
+
+                    print("HTTP error", e, "- retrying")
+                    time.sleep(self.backoff * (2 ** attempt))
+                    continue
+
+                self.count_response(response.status, started)
+
+                if response.will_close:
+                    connection.close()
+                    connection = None
+
+                if response.status >= 500 and attempt < self.retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+                    continue
+
+                if response.status >= 400:
+                    raise APIError(response.status, data)
+
+                return data
+        finally:
+            self.pool.put(connection)
+
+    def count_response(self, status, started):
+        self.responses[status] = self.responses.get(status, 0) + 1
+
+        if self.latency is not None:
+            self.latency.observe(time.monotonic() - started)
+
+    def get(self, path, parameters = None):
+        if parameters:
+            path = path + '?' + urlencode(parameters)
+
+        return self.request('GET', path)
+
+    def post(self, path, body, headers = {}):
+        return self.request('POST', path, body=body, headers=headers)
+
+    def sensor_value(self, sensor_id, value, battery = None, stats = None, when = None):
+        parameters = {'value': value}
+        if battery is not None:
+            parameters['battery'] = battery
+
+        # Spooled readings are uploaded long after they were received
+        if when is not None:
+            parameters['time'] = when
+
+        if stats is not None:
+            parameters['min'] = stats['min']
+            parameters['max'] = stats['max']
+            if 'count' in stats:
+                parameters['count'] = stats['count']
+
+        return self.get('/sensor/' + str(sensor_id), parameters)
+
+    def sensor_values(self, readings):
+        """
+        Uploads several readings in one gzipped JSON POST. Each reading keeps
+        the time it was received at, so batching does not shift it in time.
+        """
+        batch = []
+        for reading in readings:
+            entry = {'sensor': str(reading.sensor_id), 'value': reading.value, 'time': reading.time}
+            if reading.battery is not None:
+                entry['battery'] = reading.battery
+            if reading.stats is not None:
+                entry['min'] = reading.stats['min']
+                entry['max'] = reading.stats['max']
+                # Backfilled records give min and max without a count
+                if 'count' in reading.stats:
+                    entry['count'] = reading.stats['count']
+            batch.append(entry)
+
+        body = gzip.compress(json.dumps(batch, separators=(',', ':')).encode())
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        }
+
+        return self.post('/sensors', body, headers)
+
+    def upload(self, readings):
+        """
+        Sends readings as one batch when there is more than one of them and
+        the server accepts batches, one GET per reading otherwise. A failure
+        partway through the GETs raises an UploadError, readings the server
+        rejected for good are dropped.
+        """
+        refused = None
+        if len(readings) > 1 and self.batches_supported:
+            try:
+                return [self.sensor_values(readings)]
+            except APIError as e:
+                if e.status in BATCH_REJECTED_STATUSES:
+                    print("Batch upload rejected, falling back to single readings:", e)
+                    self.batches_supported = False
+                elif rejected(e):
+                    # Sent one by one, to drop only the readings at fault
+                    print("Batch refused, sending its readings one by one:", e)
+                    refused = e
+                else:
+                    raise
+
+        dropped = 0
+        results = []
+        for index, reading in enumerate(readings):
+            try:
+                results.append(self.sensor_value(reading.sensor_id, reading.value, reading.battery, reading.stats, reading.time))
+            except Exception as e:
+                if not rejected(e):
+                    raise UploadError(e, readings[index:])
+
+                # Neither kept nor spooled, it would hold up every reading
+                # behind it
+                print("Reading rejected, dropping it:", reading, e)
+                self.rejected += 1
+                dropped += 1
+
+        if refused is not None and dropped == 0:
+            # Every reading went through on its own, so it was the batch
+            # the server did not take
+            print("Batch refused but every reading accepted on its own, falling back to single readings:", refused)
+            self.batches_supported = False
+
+        return results
+
+    def close(self):
+        connections = []
+        while not self.pool.empty():
+            connections.append(self.pool.get())
+
+        for connection in connections:
+            if connection is not None:
+                connection.close()
+            self.pool.put(None)